@@ -0,0 +1,220 @@
+from __future__ import annotations
+import argparse, asyncio, gc, json, math, os, platform, resource, subprocess, sys, tempfile, time
+from pathlib import Path
+
+# Benchmarks for the render path: md_to_html (micro), Renderer.render_markdown
+# and POST /render through the FastAPI app in-process (ASGI, no sockets).
+# Prints one JSON document so runs of two versions can be diffed or plotted:
+#
+#   python -m bench.run --output before.json
+#   python -m bench.run --browser stub --requests 2000 --concurrency 32
+#
+# By default every request carries a unique trailer so the render cache and
+# single-flight coalescing are bypassed; --warm-cache sends identical inputs.
+
+ROOT = Path(__file__).resolve().parents[1]
+CORPUS_DIR = Path(__file__).resolve().parent / "corpus"
+SUITES = ("md_to_html", "render_markdown", "api_render")
+
+def load_corpus() -> dict[str, str]:
+    return {f.stem: f.read_text(encoding="utf-8") for f in sorted(CORPUS_DIR.glob("*.md"))}
+
+def summarize(latencies: list[float], elapsed: float, errors: int = 0) -> dict:
+    lat = sorted(latencies)
+    def pct(p: float) -> float:
+        return round(lat[max(0, math.ceil(p / 100 * len(lat)) - 1)] * 1000, 3) if lat else None
+    return {
+        "requests": len(lat) + errors,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 4),
+        "throughput_rps": round(len(lat) / elapsed, 2) if elapsed > 0 else None,
+        "mean_ms": round(sum(lat) / len(lat) * 1000, 3) if lat else None,
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "p99_ms": pct(99),
+        "max_ms": round(lat[-1] * 1000, 3) if lat else None,
+    }
+
+def peak_rss_mb() -> dict:
+    # ru_maxrss is KiB on Linux and bytes on macOS; children covers Chromium and render workers
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+def git_revision() -> str | None:
+    try:
+        out = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+def inputs(corpus: dict[str, str], n: int, unique: bool) -> list[tuple[str, str]]:
+    names = list(corpus)
+    out = []
+    for i in range(n):
+        name = names[i % len(names)]
+        md = corpus[name] + (f"\n\n<!-- bench {i} -->\n" if unique else "")
+        out.append((name, md))
+    return out
+
+# ---------- Suites ----------
+def bench_md_to_html(corpus: dict[str, str], iterations: int) -> dict:
+    from src.renderer import md_to_html
+    results = {}
+    for name, md in corpus.items():
+        for _ in range(min(10, iterations)):
+            md_to_html(md)
+        latencies = []
+        gc.collect()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            t = time.perf_counter()
+            md_to_html(md)
+            latencies.append(time.perf_counter() - t)
+        results[name] = {"chars": len(md), **summarize(latencies, time.perf_counter() - started)}
+    return results
+
+async def run_load(call, jobs: list[tuple[str, str]], concurrency: int) -> dict:
+    # `concurrency` clients pull from a shared list of jobs until it is empty
+    latencies: list[float] = []
+    by_doc: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    it = iter(enumerate(jobs))
+
+    async def client(c: int):
+        for i, (name, md) in it:
+            t = time.perf_counter()
+            try:
+                await call(c, md)
+            except Exception as e:
+                key = type(e).__name__ if not str(e) else f"{type(e).__name__}: {str(e)[:80]}"
+                errors[key] = errors.get(key, 0) + 1
+                continue
+            dt = time.perf_counter() - t
+            latencies.append(dt)
+            by_doc.setdefault(name, []).append(dt)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(c) for c in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    out = summarize(latencies, elapsed, sum(errors.values()))
+    out["concurrency"] = concurrency
+    out["per_document"] = {name: summarize(lat, elapsed) for name, lat in sorted(by_doc.items())}
+    for doc in out["per_document"].values():
+        del doc["throughput_rps"], doc["elapsed_s"], doc["errors"]
+    if errors:
+        out["error_kinds"] = errors
+    return out
+
+async def bench_render_markdown(renderer, jobs, concurrency: int) -> dict:
+    async def call(c: int, md: str):
+        await renderer.render_markdown(md, owner=("bench", c))
+    return await run_load(call, jobs, concurrency)
+
+async def bench_api_render(app, jobs, concurrency: int, token: str) -> dict:
+    import httpx
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def call(c: int, md: str):
+            r = await client.post("/render", json={"markdown": md}, headers={"X-API-Key": token})
+            if r.status_code != 200:
+                raise RuntimeError(f"HTTP {r.status_code}")
+        return await run_load(call, jobs, concurrency)
+
+# ---------- Setup ----------
+_STUB_PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000100e221bc330000000049454e44ae426082"
+)
+
+def stub_browser(renderer, delay_ms: float) -> None:
+    # Replace the screenshot with a fixed delay to measure everything around it
+    async def html_to_image(html, *, width=None, fmt="png", quality=85, timer=None, theme=None):
+        if delay_ms:
+            await asyncio.sleep(delay_ms / 1000)
+        return _STUB_PNG
+    renderer.html_to_image = html_to_image
+
+def configure_env(args) -> str:
+    # Run against a scratch storage/ directory with limits that would
+    # otherwise reject a load test, before src.config is imported.
+    token = os.environ.get("API_TOKEN") or "bench-token"
+    os.environ["API_TOKEN"] = token
+    os.environ["RATE_LIMIT_API"] = "0"
+    os.environ["RENDER_QUEUE_MAX"] = str(max(args.requests, 100))
+    os.environ["RENDER_QUEUE_PER_USER"] = str(max(args.requests, 5))
+    if args.browser == "stub":
+        os.environ["RENDER_WORKERS"] = "0"
+    os.chdir(tempfile.mkdtemp(prefix="md2img-bench-"))
+    sys.path.insert(0, str(ROOT))
+    return token
+
+async def main_async(args) -> dict:
+    token = configure_env(args)
+    corpus = load_corpus()
+    if args.documents:
+        corpus = {k: v for k, v in corpus.items() if k in args.documents.split(",")}
+    suites = args.suite.split(",") if args.suite else list(SUITES)
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "started_at": int(time.time()),
+            "browser": args.browser,
+            "stub_ms": args.stub_ms if args.browser == "stub" else None,
+            "warm_cache": args.warm_cache,
+            "corpus": {name: len(md) for name, md in corpus.items()},
+        },
+        "results": {},
+    }
+    if "md_to_html" in suites:
+        report["results"]["md_to_html"] = bench_md_to_html(corpus, args.iterations)
+    if "render_markdown" in suites or "api_render" in suites:
+        from src import services
+        from src.api_server import app
+        renderer = services.renderer
+        if args.browser == "stub":
+            stub_browser(renderer, args.stub_ms)
+        if not args.warm_cache:
+            renderer.cache = None
+        report["meta"]["render_concurrency"] = renderer.scheduler.concurrency
+        try:
+            # One untimed pass launches the browser/workers and loads the pipeline
+            await renderer.render_markdown(next(iter(corpus.values())), owner="bench-warmup")
+            jobs = inputs(corpus, args.requests, unique=not args.warm_cache)
+            if "render_markdown" in suites:
+                report["results"]["render_markdown"] = await bench_render_markdown(renderer, jobs, args.concurrency)
+            if "api_render" in suites:
+                report["results"]["api_render"] = await bench_api_render(app, jobs, args.concurrency, token)
+        finally:
+            await services.shutdown()
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="MD2ImageBot render benchmarks (JSON output)")
+    ap.add_argument("--suite", default="", help=f"comma-separated subset of {','.join(SUITES)} (default: all)")
+    ap.add_argument("--documents", default="", help="comma-separated corpus names (default: all in bench/corpus)")
+    ap.add_argument("--iterations", type=int, default=200, help="md_to_html calls per document")
+    ap.add_argument("--requests", type=int, default=200, help="renders per load suite")
+    ap.add_argument("--concurrency", type=int, default=8, help="concurrent clients per load suite")
+    ap.add_argument("--browser", choices=("real", "stub"), default="real",
+                    help="stub replaces Chromium screenshots with a fixed delay")
+    ap.add_argument("--stub-ms", type=float, default=0.0, help="delay of the stub screenshot")
+    ap.add_argument("--warm-cache", action="store_true", help="send identical inputs with the render cache enabled")
+    ap.add_argument("--output", help="write JSON here instead of stdout")
+    args = ap.parse_args()
+    output = Path(args.output).resolve() if args.output else None
+    report = asyncio.run(main_async(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        output.write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,442 @@
 from __future__ import annotations
-import io, json, time
-from typing import Annotated
+import asyncio, io, json, math, secrets, time, zipfile
+from contextlib import aclosing
+from typing import Annotated, Literal
 
-from fastapi import FastAPI, Body, Header, HTTPException, Response
+from fastapi import FastAPI, Body, Header, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
 from .config import cfg
-from .storage import Storage
-from .renderer import Renderer
+from .services import storage, renderer, limiter, jobs
+from .scheduler import Priority, SchedulerBusy
+from .renderer import EXTENSIONS, IMAGE_TYPES, RenderTimeout, check_format
+from .storage import PERIODS
+from .jobs import JobsFull
+from . import metrics, profiling, services
 
 app = FastAPI(title="MD2ImageBot API", version="1.0.0")
 
-storage = Storage()
-renderer = Renderer(width=cfg.render_width)
 START_TIME = int(time.time())
 
 def require_api_key(x_api_key: str | None):
     if not x_api_key or x_api_key != cfg.api_token:
         raise HTTPException(status_code=401, detail="invalid api key")
 
+def check_rate_limit(x_api_key: str, cost: int = 1, source: str = "api"):
+    wait = limiter.hit("api", x_api_key, cost)
+    if wait:
+        storage.inc_stat("rate_limited")
+        metrics.count(source, "rate_limited")
+        raise HTTPException(status_code=429, detail="rate limit exceeded", headers={"Retry-After": str(math.ceil(wait))})
+
 class RenderReq(BaseModel):
     markdown: str
     width: int | None = None
+    theme: str | None = None
+    format: str | None = None  # png | png8 | webp | jpeg; defaults to Accept, then RENDER_FORMAT
+    quality: int | None = None
+    tile_height: int | None = None  # set to get a multipart/mixed response of slices
+
+_ACCEPT_FORMATS = {"image/webp": "webp", "image/jpeg": "jpeg", "image/png": "png"}
+
+def negotiate_format(req: RenderReq, accept: str | None) -> str:
+    if req.format:
+        return req.format
+    default = renderer.fmt
+    best, best_q = None, 0.0
+    for part in (accept or "").split(","):
+        mime, _, params = part.strip().partition(";")
+        fmt = _ACCEPT_FORMATS.get(mime.strip().lower())
+        if fmt is None:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = fmt, q
+    if best is None or IMAGE_TYPES[best] == IMAGE_TYPES[default]:
+        return default
+    return best
+
+class BatchReq(BaseModel):
+    items: list[RenderReq]
+
+@app.on_event("startup")
+async def _startup():
+    services.start_warmup()
+
+@app.on_event("shutdown")
+async def _shutdown():
+    # With RUN_MODE=all main() owns shutdown: the bot still needs the services
+    # until its own runner has stopped
+    if cfg.run_mode != "all":
+        await services.shutdown()
 
 @app.get("/healthz")
 def healthz():
     return {"ok": True}
 
+@app.get("/readyz")
+def readyz():
+    # Liveness is /healthz; this only turns 200 once a render has succeeded
+    if renderer.ready or not cfg.prewarm:
+        return {"ready": True}
+    return JSONResponse(status_code=503, content={"ready": False, "error": renderer.warm_error})
+
+@app.get("/metrics")
+async def metrics_endpoint(
+    x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None,
+    authorization: Annotated[str | None, Header()] = None,
+):
+    # Prometheus scrape target; accepts the API key as X-API-Key or a bearer token.
+    # Async so the live collector reads scheduler/limiter state on the event loop.
+    if not cfg.metrics_public:
+        scheme, _, token = (authorization or "").partition(" ")
+        require_api_key(token if scheme.lower() == "bearer" else x_api_key)
+    body, content_type = metrics.render_latest()
+    return Response(content=body, media_type=content_type)
+
+if cfg.bot_mode == "webhook":
+    @app.post(cfg.webhook_path, include_in_schema=False)
+    async def telegram_webhook(
+        request: Request,
+        secret: Annotated[str | None, Header(alias="X-Telegram-Bot-Api-Secret-Token")] = None,
+    ):
+        if not secret or not secrets.compare_digest(secret, services.webhook_secret()):
+            raise HTTPException(status_code=403, detail="invalid secret token")
+        bot_app = services.bot_app
+        if bot_app is None:
+            # Telegram retries non-2xx deliveries, so nothing is lost while the bot starts
+            raise HTTPException(status_code=503, detail="bot is not running")
+        from telegram import Update
+        try:
+            data = await request.json()
+            update = Update.de_json(data, bot_app.bot) if isinstance(data, dict) else None
+        except (ValueError, TypeError, KeyError):
+            update = None
+        if update is None:
+            raise HTTPException(status_code=400, detail="invalid update")
+        await bot_app.update_queue.put(update)
+        return Response(status_code=200)
+
 @app.post("/render")
 async def render_endpoint(
     req: RenderReq,
-    x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None
+    x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None,
+    accept: Annotated[str | None, Header()] = None,
 ):
     require_api_key(x_api_key)
-    png = await renderer.render_markdown(req.markdown, width=req.width)
+    check_rate_limit(x_api_key, source="api")
+    fmt = negotiate_format(req, accept)
+    if req.tile_height:
+        return await render_tiles_response(req, fmt, x_api_key)
+    try:
+        img = await renderer.render_markdown(
+            req.markdown, width=req.width, theme=req.theme, fmt=fmt, quality=req.quality,
+            owner=("api", x_api_key), priority=Priority.BULK,
+        )
+    except ValueError as e:
+        metrics.count("api", "failed")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise render_error(e)
     storage.inc_stat("total_requests")
     storage.inc_stat("render_success")
-    return Response(content=png, media_type="image/png")
+    metrics.count("api", "success")
+    return Response(content=img, media_type=IMAGE_TYPES[fmt])
+
+def render_error(e: Exception) -> HTTPException:
+    # Counts a render that failed after validation and maps it to a status:
+    # queue full 503, deadline 504, browser or worker failures (e.g. WorkerCrashed) 500
+    if isinstance(e, SchedulerBusy):
+        storage.inc_stat("render_rejected")
+        metrics.count("api", "rejected")
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    storage.inc_stat("total_requests")
+    storage.inc_stat("render_failed")
+    metrics.count("api", "failed")
+    if isinstance(e, RenderTimeout):
+        return HTTPException(status_code=504, detail=str(e))
+    return HTTPException(status_code=500, detail=f"render failed: {str(e) or type(e).__name__}")
+
+async def render_tiles_response(req: RenderReq, fmt: str, x_api_key: str) -> StreamingResponse:
+    # Each slice becomes one part as soon as it is captured. The first one is
+    # awaited here, so a full queue or a failed render still gets a proper
+    # status instead of a 200 with an empty body.
+    try:
+        renderer.pipeline.version(req.theme)
+        check_format(fmt)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    boundary = secrets.token_hex(16)
+    tiles = renderer.render_tiles(
+        req.markdown, width=req.width, theme=req.theme, fmt=fmt, quality=req.quality,
+        tile_height=req.tile_height, owner=("api", x_api_key), priority=Priority.BULK,
+    )
+    try:
+        first = await anext(tiles, None)
+    except Exception as e:
+        await tiles.aclose()
+        raise render_error(e)
+    except BaseException:
+        await tiles.aclose()  # client went away while queued: release the slot
+        raise
+    storage.inc_stat("total_requests")
+
+    def part(n: int, tile: bytes) -> bytes:
+        return (
+            f"--{boundary}\r\nContent-Type: {IMAGE_TYPES[fmt]}\r\n"
+            f'Content-Disposition: attachment; filename="{n:03d}.{EXTENSIONS[fmt]}"\r\n'
+            f"Content-Length: {len(tile)}\r\n\r\n"
+        ).encode("ascii") + tile + b"\r\n"
+
+    async def stream():
+        n = 0
+        async with aclosing(tiles):
+            if first is not None:
+                n += 1
+                yield part(n, first)
+            try:
+                async for tile in tiles:
+                    n += 1
+                    yield part(n, tile)
+            except Exception:
+                storage.inc_stat("render_failed")
+                metrics.count("api", "failed")
+                raise
+        storage.inc_stat("render_success")
+        metrics.count("api", "success")
+        yield f"--{boundary}--\r\n".encode("ascii")
+
+    return StreamingResponse(stream(), media_type=f"multipart/mixed; boundary={boundary}")
+
+class _ZipSink(io.RawIOBase):
+    # Write-only, unseekable target for ZipFile; bytes are handed out via drain()
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        return out
+
+@app.post("/render/batch")
+async def render_batch_endpoint(
+    req: BatchReq,
+    x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None,
+    accept: Annotated[str | None, Header()] = None,
+):
+    require_api_key(x_api_key)
+    if not req.items:
+        raise HTTPException(status_code=400, detail="items must not be empty")
+    if len(req.items) > cfg.batch_max_items:
+        raise HTTPException(status_code=400, detail=f"at most {cfg.batch_max_items} items per batch")
+    check_rate_limit(x_api_key, cost=len(req.items), source="api_batch")
+    # Keep this batch's own queue inside the per-owner limit of the scheduler
+    fan_out = asyncio.Semaphore(max(1, renderer.scheduler.per_owner_queue))
+
+    async def render_one(i: int, item: RenderReq):
+        # The batch response itself is a ZIP, so Accept only applies when it
+        # names an image type explicitly.
+        fmt = negotiate_format(item, accept)
+        async with fan_out:
+            try:
+                img = await renderer.render_markdown(
+                    item.markdown, width=item.width, theme=item.theme, fmt=fmt, quality=item.quality,
+                    owner=("api", x_api_key), priority=Priority.BULK,
+                )
+                return i, f"{i:03d}.{EXTENSIONS[fmt]}", img, None, "success"
+            except SchedulerBusy as e:
+                return i, None, None, str(e), "rejected"
+            except Exception as e:
+                return i, None, None, str(e) or type(e).__name__, "failed"
+
+    async def stream():
+        tasks = [asyncio.create_task(render_one(i, item)) for i, item in enumerate(req.items)]
+        sink = _ZipSink()
+        manifest = []
+        try:
+            with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as zf:
+                for done in asyncio.as_completed(tasks):
+                    i, name, img, error, result = await done
+                    storage.inc_stat("total_requests")
+                    metrics.count("api_batch", result)
+                    if error is None:
+                        zf.writestr(name, img)
+                        manifest.append({"index": i, "ok": True, "file": name})
+                        storage.inc_stat("render_success")
+                    else:
+                        manifest.append({"index": i, "ok": False, "error": error})
+                        storage.inc_stat("render_failed")
+                    yield sink.drain()
+                manifest.sort(key=lambda m: m["index"])
+                zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+            yield sink.drain()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        stream(), media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="renders.zip"'},
+    )
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    req: RenderReq,
+    response: Response,
+    x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None,
+    accept: Annotated[str | None, Header()] = None,
+):
+    require_api_key(x_api_key)
+    if req.tile_height:
+        raise HTTPException(status_code=400, detail="tile_height is not supported for jobs")
+    fmt = negotiate_format(req, accept)
+    # Reject bad input now rather than as a failed job later
+    try:
+        renderer.pipeline.version(req.theme)
+        check_format(fmt)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    check_rate_limit(x_api_key, source="api_jobs")
+
+    async def render() -> bytes:
+        storage.inc_stat("total_requests")
+        try:
+            img = await renderer.render_markdown(
+                req.markdown, width=req.width, theme=req.theme, fmt=fmt, quality=req.quality,
+                owner=("api", x_api_key), priority=Priority.BULK,
+            )
+        except SchedulerBusy:
+            storage.inc_stat("render_rejected")
+            metrics.count("api_jobs", "rejected")
+            raise
+        except Exception:
+            storage.inc_stat("render_failed")
+            metrics.count("api_jobs", "failed")
+            raise
+        storage.inc_stat("render_success")
+        metrics.count("api_jobs", "success")
+        return img
+
+    try:
+        job = jobs.submit(render, owner=("api", x_api_key), media_type=IMAGE_TYPES[fmt])
+    except JobsFull as e:
+        metrics.count("api_jobs", "rejected")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    response.headers["Location"] = f"/jobs/{job.id}"
+    return jobs.describe(job)
+
+def get_job(job_id: str, x_api_key: str | None):
+    # Jobs are tasks on the event loop, so every /jobs endpoint is async
+    require_api_key(x_api_key)
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None):
+    return jobs.describe(get_job(job_id, x_api_key))
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str, x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None):
+    job = get_job(job_id, x_api_key)
+    if job.status in ("queued", "running"):
+        raise HTTPException(status_code=409, detail=f"job is {job.status}", headers={"Retry-After": "1"})
+    if job.status == "failed":
+        raise HTTPException(status_code=409, detail=f"job failed: {job.error}")
+    img = await jobs.result(job) if job.status == "done" else None
+    if img is None:
+        raise HTTPException(status_code=410, detail="job result expired")
+    return Response(content=img, media_type=job.media_type)
+
+@app.delete("/jobs/{job_id}", status_code=204)
+async def job_delete(job_id: str, x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None):
+    jobs.cancel(get_job(job_id, x_api_key))
+    return Response(status_code=204)
 
 @app.get("/stats")
-def stats(
+async def stats(
     x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None
 ):
+    # Runs on the event loop, which owns the limiter/scheduler/job state read
+    # below; only the storage queries go to a thread
     require_api_key(x_api_key)
     now = int(time.time())
-    st = storage.get()
-    return {"uptime_seconds": now - START_TIME, "stats": st["stats"], "config": st["config"]}
+    totals, config = await asyncio.to_thread(lambda: (storage.totals(), storage.config()))
+    return {
+        "uptime_seconds": now - START_TIME,
+        "stats": totals,
+        "render_cache": renderer.cache.stats() if renderer.cache else None,
+        "scheduler": renderer.scheduler.stats(),
+        "coalesced_renders": renderer.coalesced,
+        "fast_renders": renderer.fast_renders,
+        "workers": renderer.workers.stats() if renderer.workers else None,
+        "browser_pool": renderer.pool.stats() if renderer.workers is None else None,
+        "rate_limits": limiter.stats(),
+        "jobs": jobs.stats(),
+        "config": config,
+    }
+
+@app.get("/stats/users")
+def stats_users(
+    sort: Literal["requests", "render_success"] = "requests",
+    limit: Annotated[int, Query(ge=1, le=500)] = 50,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None,
+):
+    # Top-N / paginated per-user counters, highest first
+    require_api_key(x_api_key)
+    items = storage.top_users(sort, limit, offset)
+    return {
+        "sort": sort, "limit": limit, "offset": offset,
+        "items": [{"user_id": uid, **counters} for uid, counters in items],
+    }
+
+@app.get("/stats/users/{user_id}")
+def stats_user(user_id: int, x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None):
+    require_api_key(x_api_key)
+    counters = storage.user_stats(user_id)
+    if counters is None:
+        raise HTTPException(status_code=404, detail="unknown user")
+    return {"user_id": user_id, **counters}
+
+_SERIES_DEFAULT = {"hour": 24, "day": 30}  # buckets returned when `since` is omitted
+_SERIES_MAX = {"hour": 24 * 31, "day": 366}
+
+@app.get("/stats/timeseries")
+def stats_timeseries(
+    period: Literal["hour", "day"] = "hour",
+    since: int | None = None,
+    until: int | None = None,
+    x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None,
+):
+    # Global counters per UTC hour/day; each item's `start` is the bucket's unix time
+    require_api_key(x_api_key)
+    step = PERIODS[period]
+    until = until if until is not None else int(time.time())
+    since = since if since is not None else until - (_SERIES_DEFAULT[period] - 1) * step
+    since -= since % step
+    if since > until or (until - since) // step >= _SERIES_MAX[period]:
+        raise HTTPException(status_code=400, detail=f"at most {_SERIES_MAX[period]} buckets per request")
+    return {
+        "period": period,
+        "items": [{"start": start, **counters} for start, counters in storage.buckets(period, since, until)],
+    }
 
 class PublicReq(BaseModel):
     enabled: bool
@@ -71,3 +462,41 @@ def admin_blacklist(req: ListReq, x_api_key: Annotated[str | None, Header(alias=
     require_api_key(x_api_key)
     storage.modify_list("blacklist", add=req.add, remove=req.remove)
     return {"blacklist": storage.config().get("blacklist", [])}
+
+class ProfileReq(BaseModel):
+    seconds: float = 10
+    interval_ms: float = 5
+    format: Literal["json", "collapsed"] = "json"  # collapsed: flamegraph.pl / speedscope input
+
+@app.post("/admin/profile")
+async def admin_profile(req: ProfileReq, x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None):
+    # Samples this process's threads for `seconds`, then returns the profile
+    require_api_key(x_api_key)
+    if not 0 < req.seconds <= cfg.profile_max_seconds:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {cfg.profile_max_seconds:g}]")
+    if not 1 <= req.interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms must be in [1, 1000]")
+    try:
+        profile = await asyncio.to_thread(profiling.sample, req.seconds, req.interval_ms / 1000)
+    except profiling.ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if req.format == "collapsed":
+        return PlainTextResponse(profiling.collapsed(profile))
+    return profiling.summary(profile)
+
+@app.get("/admin/tasks")
+async def admin_tasks(x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None):
+    require_api_key(x_api_key)
+    tasks = profiling.dump_tasks()
+    return {"count": len(tasks), "tasks": tasks}
+
+@app.get("/admin/slow-renders")
+def admin_slow_renders(
+    sort: Literal["recent", "slowest"] = "recent",
+    x_api_key: Annotated[str | None, Header(alias="X-API-Key")] = None,
+):
+    require_api_key(x_api_key)
+    log = renderer.slow_renders
+    if log is None:
+        return {"threshold_ms": 0, "recorded": 0, "items": []}
+    return {"threshold_ms": log.threshold_ms, "recorded": log.recorded, "items": log.entries(slowest=sort == "slowest")}
@@ -1,13 +1,16 @@
 from __future__ import annotations
-import asyncio, io, time
+import asyncio, io, math, time
 from typing import Optional
 
-from telegram import Update, InputFile
+from telegram import Update, InputFile, InputMediaDocument, InputMediaPhoto
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
 
 from .config import cfg
 from .storage import Storage
-from .renderer import Renderer
+from .renderer import EXTENSIONS, Renderer, RenderTimeout, image_size
+from .scheduler import Priority, SchedulerBusy
+from . import metrics, services
 from .utils import parse_ints
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
@@ -17,7 +20,7 @@ from telegram.ext import CallbackQueryHandler
 START_TIME = int(time.time())
 
 class BotApp:
-        async def cmd_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def cmd_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         is_admin = self._is_admin(update.effective_user.id)
         rows = [
             [InlineKeyboardButton("📝 渲染说明 /help", callback_data="show_help")],
@@ -56,19 +59,7 @@ class BotApp:
             if not is_admin:
                 await query.message.reply_text("需要管理员权限。")
                 return
-            st = self.storage.get()
-            uptime = int(time.time()) - START_TIME
-            stats = st["stats"]; conf = st["config"]
-            msg = (
-                f"🟢 运行中\n"
-                f"Uptime: {uptime}s\n"
-                f"公开使用: {conf.get('public_enabled', True)}\n"
-                f"白名单: {len(conf.get('whitelist', []))} 人\n"
-                f"黑名单: {len(conf.get('blacklist', []))} 人\n"
-                f"总请求: {stats.get('total_requests',0)}\n"
-                f"成功: {stats.get('render_success',0)} / 失败: {stats.get('render_failed',0)}\n"
-            )
-            await query.message.reply_text(msg)
+            await query.message.reply_text(self._status_text())
             return
 
         if data == "cmd_public_on":
@@ -92,29 +83,42 @@ class BotApp:
             await query.message.reply_text("请在输入框执行相应命令，例如 /wl_add 123456")
             return
 
-    def __init__(self):
-        self.storage = Storage()
-        self.renderer = Renderer(width=cfg.render_width)
-        self.app = Application.builder().token(cfg.bot_token).build()
+    def __init__(self, storage: Optional[Storage] = None, renderer: Optional[Renderer] = None):
+        self.storage = storage or services.storage
+        self.renderer = renderer or services.renderer
+        self.limiter = services.limiter
+        self.file_ids = services.file_ids
+        self._admin_ids = frozenset(cfg.admin_ids)
+        builder = Application.builder().token(cfg.bot_token)
+        if cfg.bot_mode == "webhook":
+            builder = builder.updater(None)  # updates arrive via the API's webhook route
+        self.app = builder.build()
         self._register_handlers()
         self._load_plugins()
 
     # ---------- Permissions ----------
     def _is_admin(self, uid: int) -> bool:
-        return uid in cfg.admin_ids
+        return uid in self._admin_ids
 
     def _is_authorized(self, uid: int) -> bool:
-        state = self.storage.get()
-        conf = state["config"]
-        wl: list[int] = conf["whitelist"]
-        bl: list[int] = conf["blacklist"]
-        if uid in bl:
+        # In-memory snapshot kept current by Storage; no disk access here
+        auth = self.storage.auth()
+        if uid in auth.blacklist:
             return False
         if self._is_admin(uid):
             return True
-        if conf.get("public_enabled", True):
+        if auth.public_enabled:
             return True
-        return uid in wl
+        return uid in auth.whitelist
+
+    def _throttle(self, uid: int, chat) -> float:
+        # Seconds until this user/chat may render again; 0 when allowed
+        if self._is_admin(uid):
+            return 0.0
+        wait = self.limiter.hit("user", uid)
+        if not wait and chat is not None and chat.type != "private":
+            wait = self.limiter.hit("chat", chat.id)
+        return wait
 
     # ---------- Handlers ----------
     def _register_handlers(self):
@@ -136,11 +140,21 @@ class BotApp:
         self.app.add_handler(CommandHandler("bl_list", self.cmd_bl_list))
 
         # Content render
-        self.app.add_handler(CommandHandler("render", self.cmd_render))
-        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.on_text))
+        # Private/group messages only: channel posts have no effective_user and
+        # go to the channel handler below (or the plugin that replaces it)
+        self.app.add_handler(CommandHandler("render", self.cmd_render, filters=filters.UpdateType.MESSAGE))
+        self.app.add_handler(MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND, self.on_text))
 
         # Channel posts (basic support even without plugin)
-        self.app.add_handler(MessageHandler(filters.UpdateType.CHANNEL_POST, self.on_channel_post))
+        self._channel_handler = MessageHandler(filters.UpdateType.CHANNEL_POST, self.on_channel_post)
+        self.app.add_handler(self._channel_handler)
+
+    def disable_channel_fallback(self):
+        # Called by plugins that handle channel posts themselves, so each post
+        # is rendered and answered exactly once
+        if self._channel_handler is not None:
+            self.app.remove_handler(self._channel_handler)
+            self._channel_handler = None
 
     def _load_plugins(self):
         from importlib import import_module
@@ -185,20 +199,43 @@ class BotApp:
         uid = update.effective_user.id
         if not self._is_admin(uid):
             return
-        st = self.storage.get()
+        await update.effective_message.reply_text(self._status_text())
+
+    def _status_text(self) -> str:
+        stats = self.storage.totals()
+        conf = self.storage.config()
         uptime = int(time.time()) - START_TIME
-        stats = st["stats"]
-        conf = st["config"]
         msg = (
             f"🟢 运行中\n"
             f"Uptime: {uptime}s\n"
             f"公开使用: {conf.get('public_enabled', True)}\n"
             f"白名单: {len(conf.get('whitelist', []))} 人\n"
             f"黑名单: {len(conf.get('blacklist', []))} 人\n"
+            f"用户: {stats['users']} 人\n"
             f"总请求: {stats.get('total_requests',0)}\n"
             f"成功: {stats.get('render_success',0)} / 失败: {stats.get('render_failed',0)}\n"
         )
-        await update.effective_message.reply_text(msg)
+        if self.renderer.cache:
+            cs = self.renderer.cache.stats()
+            msg += f"缓存命中: {cs['hits']}（磁盘 {cs['disk_hits']}） / 未命中: {cs['misses']}\n"
+        fs = self.file_ids.stats()
+        msg += f"file_id 复用: {fs['hits']} / 未命中: {fs['misses']} / 条目: {fs['items']}\n"
+        ss = self.renderer.scheduler.stats()
+        msg += f"渲染中: {ss['active']}/{ss['concurrency']} / 排队: {ss['queued']} / 拒绝: {ss['rejected']} / 合并: {self.renderer.coalesced}\n"
+        if self.renderer.workers is not None:
+            ws = self.renderer.workers.stats()
+            msg += f"渲染进程: {ws['connected']}/{ws['workers']} 在线 / 进行中 {ws['in_flight']} / 重启 {ws['restarts']} / 强制结束 {ws['killed']}\n"
+        elif self.renderer.pool.started:
+            ps = self.renderer.pool.stats()
+            msg += f"浏览器: {ps['browsers']} 个 / 空闲页 {ps['idle_pages']} / 内存 {ps['rss_mb']} MB\n"
+        msg += (
+            f"浏览器干预: 超时 {stats.get('browser_timeouts',0)} / 页面崩溃 {stats.get('browser_page_crashes',0)}"
+            f" / 浏览器崩溃 {stats.get('browser_browser_crashes',0)} / 按次数回收 {stats.get('browser_recycled_renders',0)}"
+            f" / 按内存回收 {stats.get('browser_recycled_rss',0)} / 重新启动 {stats.get('browser_relaunches',0)}\n"
+        )
+        for kind, rs in self.limiter.stats().items():
+            msg += f"限流[{kind}] {rs['rate']}: 跟踪 {rs['tracked']} / 受限中 {rs['throttled']} / 累计拦截 {rs['limited_total']}\n"
+        return msg
 
     async def cmd_wl_add(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not self._is_admin(update.effective_user.id):
@@ -249,7 +286,7 @@ class BotApp:
         if not text:
             await msg.reply_text("请发送 /render <markdown> 或回复一条包含 Markdown 的消息。")
             return
-        await self._render_and_reply(update, text)
+        await self._render_and_reply(update, text, source="command")
 
     async def on_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not self._is_authorized(update.effective_user.id):
@@ -257,7 +294,8 @@ class BotApp:
         text = update.effective_message.text or ""
         if not text.strip():
             return
-        await self._render_and_reply(update, text)
+        source = "dm" if update.effective_chat.type == "private" else "group"
+        await self._render_and_reply(update, text, source=source)
 
     async def on_channel_post(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Fallback: if plugin not loaded, still try to render
@@ -267,30 +305,153 @@ class BotApp:
         text = post.text or post.caption or ""
         if not text.strip():
             return
+        if self.limiter.hit("chat", post.chat_id):
+            self.storage.inc_stat("rate_limited")
+            metrics.count("channel", "rate_limited")
+            return
         try:
-            png = await self.renderer.render_markdown(text)
-            bio = io.BytesIO(png); bio.name = "render.png"
-            await post.reply_document(document=InputFile(bio), caption="已自动转换为图片")
+            await self.render_and_send(post, text, caption="已自动转换为图片", owner=("chat", post.chat_id), priority=Priority.CHANNEL)
             self.storage.inc_stat("total_requests")
             self.storage.inc_stat("render_success")
+            metrics.count("channel", "success")
+        except SchedulerBusy as e:
+            self.storage.inc_stat("total_requests")
+            self.storage.inc_stat("render_rejected")
+            metrics.count("channel", "rejected")
+            print(f"channel_post render skipped: {e}")
         except Exception as e:
             self.storage.inc_stat("total_requests")
             self.storage.inc_stat("render_failed")
+            metrics.count("channel", "failed")
             print(f"channel_post render error: {e}")
 
-    async def _render_and_reply(self, update: Update, text: str):
+    def _as_photo(self, data: bytes) -> bool:
+        # Small images go out as photos (inline preview); large or very tall
+        # ones as documents so Telegram does not downscale them.
+        if len(data) > cfg.photo_max_kb * 1024:
+            return False
+        w, h = image_size(data)
+        return max(w, h) <= 2560 and w + h <= 10000
+
+    async def send_image(self, msg, data: bytes, caption: str):
+        bio = io.BytesIO(data); bio.name = f"render.{EXTENSIONS[self.renderer.fmt]}"
+        started = time.perf_counter()
+        try:
+            if self._as_photo(data):
+                return await msg.reply_photo(photo=InputFile(bio), caption=caption)
+            return await msg.reply_document(document=InputFile(bio), caption=caption)
+        finally:
+            metrics.observe("upload", time.perf_counter() - started)
+
+    async def send_tiles(self, msg, tiles: list, caption: str | None, as_photo: bool | None = None):
+        # One media group (max 10 items); photos and documents cannot be mixed.
+        # Items are image bytes, or file_id strings when re-sending.
+        ext = EXTENSIONS[self.renderer.fmt]
+        if as_photo is None:
+            as_photo = all(self._as_photo(t) for t in tiles)
+        cls = InputMediaPhoto if as_photo else InputMediaDocument
+        media = []
+        for i, item in enumerate(tiles):
+            if isinstance(item, bytes):
+                bio = io.BytesIO(item); bio.name = f"render-{i + 1}.{ext}"
+                item = InputFile(bio)
+            media.append(cls(media=item, caption=caption if i == 0 else None))
+        started = time.perf_counter()
+        try:
+            return await msg.reply_media_group(media=media)
+        finally:
+            metrics.observe("upload", time.perf_counter() - started)
+
+    @staticmethod
+    def _sent_file(sent) -> tuple[str, str]:
+        if sent.photo:
+            return "photo", sent.photo[-1].file_id
+        return "document", sent.document.file_id
+
+    @staticmethod
+    def _media_groups(items: list) -> list[list]:
+        # Telegram albums take 2-10 items: split evenly so no group is left with one
+        n = -(-len(items) // 10)
+        return [items[i * len(items) // n:(i + 1) * len(items) // n] for i in range(n)]
+
+    async def _resend(self, msg, group: list[tuple[str, str]], caption: str | None):
+        # One media group of (kind, file_id); a group never mixes kinds
+        kind = group[0][0]
+        if len(group) == 1:
+            if kind == "photo":
+                await msg.reply_photo(photo=group[0][1], caption=caption)
+            else:
+                await msg.reply_document(document=group[0][1], caption=caption)
+            return
+        await self.send_tiles(msg, [file_id for _, file_id in group], caption, as_photo=kind == "photo")
+
+    async def render_and_send(self, msg, text: str, caption: str, *, owner, priority: Priority):
+        # Identical content that was uploaded before is re-sent by file_id
+        # without rendering. Pages taller than TILE_HEIGHT are rendered in
+        # tiles and sent as media groups so no single huge bitmap is produced.
+        # If a stale file_id breaks the resend midway, only the groups not yet
+        # in the chat are rendered and sent.
+        key = self.renderer.render_key(text)
+        cached = self.file_ids.get(key)
+        files: list[tuple[str, str]] = []  # (kind, file_id) of pages already in the chat
+        resumed = 0  # media groups already in the chat
+        if cached is not None:
+            kinds, ids = cached
+            if isinstance(kinds, str):
+                kinds = [kinds] * len(ids)
+            try:
+                for group in self._media_groups(list(zip(kinds, ids))):
+                    await self._resend(msg, group, caption if not files else None)
+                    files += group
+                    resumed += 1
+                return
+            except BadRequest as e:
+                self.file_ids.discard(key)
+                print(f"file_id resend failed after {len(files)} of {len(ids)} pages, re-rendering: {e}")
+        # Uploads start only after the render has released its scheduler slot
+        if cfg.tile_height:
+            pages = await self.renderer.render_pages(text, owner=owner, priority=priority)
+        else:
+            pages = [await self.renderer.render_markdown(text, owner=owner, priority=priority)]
+        if resumed and len(pages) != len(ids):
+            files, resumed = [], 0  # paged differently (e.g. TILE_HEIGHT changed): send it all
+        for group in self._media_groups(pages)[resumed:]:
+            first = None if files else caption
+            if len(group) == 1:
+                sent_msgs = [await self.send_image(msg, group[0], caption=first)]
+            else:
+                sent_msgs = await self.send_tiles(msg, group, first)
+            files += [self._sent_file(m) for m in sent_msgs]
+        if files:
+            self.file_ids.put(key, [kind for kind, _ in files], [file_id for _, file_id in files])
+
+    async def _render_and_reply(self, update: Update, text: str, source: str):
         msg = update.effective_message
         uid = update.effective_user.id
+        wait = self._throttle(uid, update.effective_chat)
+        if wait:
+            self.storage.inc_stat("rate_limited")
+            metrics.count(source, "rate_limited")
+            await msg.reply_text(f"🐢 请求太频繁，请 {math.ceil(wait)} 秒后再试。")
+            return
         self.storage.inc_stat("total_requests")
         self.storage.inc_user(uid, "requests")
         try:
-            png = await self.renderer.render_markdown(text)
-            bio = io.BytesIO(png); bio.name = "render.png"
-            await msg.reply_document(document=InputFile(bio), caption="✅ 已转换为图片")
+            await self.render_and_send(msg, text, caption="✅ 已转换为图片", owner=("user", uid), priority=Priority.INTERACTIVE)
             self.storage.inc_stat("render_success")
             self.storage.inc_user(uid, "render_success")
+            metrics.count(source, "success")
+        except SchedulerBusy as e:
+            self.storage.inc_stat("render_rejected")
+            metrics.count(source, "rejected")
+            await msg.reply_text(f"⏳ 渲染队列繁忙，请约 {e.retry_after} 秒后再试。")
+        except RenderTimeout:
+            self.storage.inc_stat("render_failed")
+            metrics.count(source, "failed")
+            await msg.reply_text("⌛ 渲染超时，请精简内容后重试。")
         except Exception as e:
             self.storage.inc_stat("render_failed")
+            metrics.count(source, "failed")
             await msg.reply_text(f"❌ 渲染失败：{e}")
 
     async def run_polling(self):
@@ -298,12 +459,45 @@ class BotApp:
         print("Bot started. Polling updates...")
         await self.app.start()
         await self.app.updater.start_polling()
-        await self.app.updater.wait()
-        await self.app.stop()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.app.updater.stop()
+            await self.app.stop()
+            await self.app.shutdown()
+
+    async def run_webhook(self):
+        # Telegram POSTs updates to the FastAPI route, which puts them on
+        # self.app.update_queue; any replica behind the load balancer can take them.
+        await self.app.initialize()
+        await self.app.start()
+        services.bot_app = self.app
+        if cfg.webhook_url:
+            await self.app.bot.set_webhook(
+                url=cfg.webhook_url.rstrip("/") + cfg.webhook_path,
+                secret_token=services.webhook_secret(),
+                allowed_updates=Update.ALL_TYPES,
+            )
+        print(f"Bot started. Receiving updates on {cfg.webhook_path}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            services.bot_app = None
+            await self.app.stop()
+            await self.app.shutdown()
+
+    async def run(self):
+        if cfg.bot_mode == "webhook":
+            await self.run_webhook()
+        else:
+            await self.run_polling()
 
 async def main():
     app = BotApp()
-    await app.run_polling()
+    try:
+        await app.run()
+    finally:
+        await services.shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,195 @@
+from __future__ import annotations
+import asyncio, json, os, threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+# Content-addressed cache for rendered images. Keys are hex digests computed by
+# the renderer; values are the encoded image bytes. A bounded in-memory LRU sits
+# in front of an optional on-disk tier that is evicted oldest-first by size.
+class RenderCache:
+    def __init__(
+        self,
+        max_items: int = 256,
+        max_bytes: int = 64 * 1024 * 1024,
+        disk_dir: str | None = None,
+        disk_max_bytes: int = 0,
+    ):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir and disk_max_bytes > 0 else None
+        self._mem: OrderedDict[str, bytes] = OrderedDict()
+        self._mem_bytes = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()  # key -> size, oldest first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._scan_disk()
+
+    # ---------- Memory tier ----------
+    def _mem_get(self, key: str) -> Optional[bytes]:
+        data = self._mem.get(key)
+        if data is not None:
+            self._mem.move_to_end(key)
+        return data
+
+    def _mem_put(self, key: str, data: bytes) -> None:
+        if self.max_items <= 0 or len(data) > self.max_bytes:
+            return
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= len(old)
+        self._mem[key] = data
+        self._mem_bytes += len(data)
+        while self._mem and (len(self._mem) > self.max_items or self._mem_bytes > self.max_bytes):
+            _, evicted = self._mem.popitem(last=False)
+            self._mem_bytes -= len(evicted)
+
+    # ---------- Disk tier ----------
+    def _file(self, key: str) -> Path:
+        return self.disk_dir / key[:2] / f"{key}.bin"
+
+    def _scan_disk(self) -> None:
+        entries = []
+        for f in self.disk_dir.glob("*/*.bin"):
+            try:
+                st = f.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, f.stem, st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def _disk_get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+        f = self._file(key)
+        try:
+            data = f.read_bytes()
+            os.utime(f)
+        except OSError:
+            with self._lock:
+                size = self._disk.pop(key, None)
+                if size is not None:
+                    self._disk_bytes -= size
+            return None
+        return data
+
+    def _disk_put(self, key: str, data: bytes) -> None:
+        if len(data) > self.disk_max_bytes:
+            return
+        f = self._file(key)
+        f.parent.mkdir(parents=True, exist_ok=True)
+        tmp = f.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        tmp.replace(f)
+        with self._lock:
+            old = self._disk.pop(key, None)
+            if old is not None:
+                self._disk_bytes -= old
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        while self._disk and self._disk_bytes > self.disk_max_bytes:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                self._file(key).unlink()
+            except OSError:
+                pass
+
+    # ---------- Public API ----------
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self._mem_get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        if self.disk_dir is not None:
+            data = await asyncio.to_thread(self._disk_get, key)
+            if data is not None:
+                self.hits += 1
+                self.disk_hits += 1
+                self._mem_put(key, data)
+                return data
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, data: bytes) -> None:
+        self._mem_put(key, data)
+        if self.disk_dir is not None:
+            try:
+                await asyncio.to_thread(self._disk_put, key, data)
+            except OSError as e:
+                print(f"[render_cache] disk write failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_items": len(self._mem),
+            "memory_bytes": self._mem_bytes,
+            "disk_items": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+        }
+
+# Telegram file_ids of images the bot has already uploaded, keyed by the
+# render key (content hash plus output settings). Re-sending by file_id needs
+# no upload and no browser work. Bounded LRU, persisted as JSON on close.
+class FileIdCache:
+    def __init__(self, max_items: int = 10_000, path: str | None = None):
+        self.max_items = max_items
+        self.path = Path(path) if path else None
+        # key -> (kinds, file_ids), one kind per file_id; older entries (and
+        # files) hold a single kind string for all of them
+        self._items: OrderedDict[str, tuple[str | list[str], list[str]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.path is not None and self.path.exists():
+            try:
+                for key, (kind, ids) in json.loads(self.path.read_text(encoding="utf-8")).items():
+                    self._items[key] = (kind if isinstance(kind, str) else list(kind), list(ids))
+            except (OSError, ValueError) as e:
+                print(f"[file_id_cache] ignoring unreadable {self.path}: {e}")
+
+    def get(self, key: str) -> Optional[tuple[str | list[str], list[str]]]:
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item
+
+    def put(self, key: str, kinds: str | list[str], file_ids: list[str]) -> None:
+        if self.max_items <= 0:
+            return
+        self._items[key] = (kinds if isinstance(kinds, str) else list(kinds), list(file_ids))
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def discard(self, key: str) -> None:
+        self._items.pop(key, None)
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(dict(self._items), ensure_ascii=False), encoding="utf-8")
+        tmp.replace(self.path)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "items": len(self._items)}
@@ -31,6 +31,59 @@ class Config:
     api_port: int = int(os.getenv("API_PORT","8000"))
     api_token: str = os.getenv("API_TOKEN","")
     render_width: int = int(os.getenv("RENDER_WIDTH","1024"))
+    render_theme: str = os.getenv("RENDER_THEME","github-markdown")
+    render_format: str = os.getenv("RENDER_FORMAT","png")  # png | png8 | webp | jpeg
+    render_quality: int = int(os.getenv("RENDER_QUALITY","85"))
+    tile_height: int = int(os.getenv("TILE_HEIGHT","2048"))
+    photo_max_kb: int = int(os.getenv("PHOTO_MAX_KB","1024"))
+    browser_pool_size: int = int(os.getenv("BROWSER_POOL_SIZE","1"))
+    pages_per_browser: int = int(os.getenv("PAGES_PER_BROWSER","2"))
+    # Browser supervisor: per-render deadline, recycling after N renders or past
+    # an RSS limit (0 disables each), and how often browsers are checked
+    render_timeout: float = float(os.getenv("RENDER_TIMEOUT","20"))
+    browser_recycle_renders: int = int(os.getenv("BROWSER_RECYCLE_RENDERS","500"))
+    browser_max_rss_mb: int = int(os.getenv("BROWSER_MAX_RSS_MB","1024"))
+    browser_check_interval: float = float(os.getenv("BROWSER_CHECK_INTERVAL","30"))
+    render_workers: int = int(os.getenv("RENDER_WORKERS","0"))  # 0 = render in-process
+    # Browserless Pillow renderer for simple Markdown; extra fonts are
+    # comma-separated paths tried after the built-in candidates (e.g. a CJK font)
+    fast_render: bool = _bool(os.getenv("FAST_RENDER"), True)
+    fast_render_fonts: str = os.getenv("FAST_RENDER_FONTS","")
+    # Diagnostics: renders slower than SLOW_RENDER_MS (0 disables) are kept in a
+    # ring buffer of SLOW_RENDER_KEEP entries, with the Markdown if SLOW_RENDER_CAPTURE
+    slow_render_ms: float = float(os.getenv("SLOW_RENDER_MS","1000"))
+    slow_render_keep: int = int(os.getenv("SLOW_RENDER_KEEP","50"))
+    slow_render_capture: bool = _bool(os.getenv("SLOW_RENDER_CAPTURE"), False)
+    profile_max_seconds: float = float(os.getenv("PROFILE_MAX_SECONDS","60"))
+    storage_backend: str = os.getenv("STORAGE_BACKEND","json")
+    storage_path: str = os.getenv("STORAGE_PATH","")
+    stats_flush_interval: float = float(os.getenv("STATS_FLUSH_INTERVAL","30"))
+    stats_hourly_days: int = int(os.getenv("STATS_HOURLY_DAYS","14"))  # hourly buckets kept this long; 0 = forever
+    render_concurrency: int = int(os.getenv("RENDER_CONCURRENCY","0"))  # 0 = pool capacity
+    render_queue_max: int = int(os.getenv("RENDER_QUEUE_MAX","100"))
+    render_queue_per_user: int = int(os.getenv("RENDER_QUEUE_PER_USER","5"))
+    # Token buckets as "<requests>/<seconds>"; empty or 0 disables
+    rate_limit_user: str = os.getenv("RATE_LIMIT_USER","20/60")
+    rate_limit_chat: str = os.getenv("RATE_LIMIT_CHAT","30/60")
+    rate_limit_api: str = os.getenv("RATE_LIMIT_API","120/60")
+    batch_max_items: int = int(os.getenv("BATCH_MAX_ITEMS","50"))
+    # Async render jobs (POST /jobs): results kept JOBS_TTL seconds after finishing,
+    # JOBS_MEMORY_MB in memory then JOBS_DISK_MB under storage/jobs (0 = drop instead)
+    jobs_ttl: float = float(os.getenv("JOBS_TTL","3600"))
+    jobs_max: int = int(os.getenv("JOBS_MAX","1000"))
+    jobs_memory_mb: int = int(os.getenv("JOBS_MEMORY_MB","64"))
+    jobs_disk_mb: int = int(os.getenv("JOBS_DISK_MB","256"))
+    file_id_cache_items: int = int(os.getenv("FILE_ID_CACHE_ITEMS","10000"))
+    render_cache_items: int = int(os.getenv("RENDER_CACHE_ITEMS","256"))
+    render_cache_mb: int = int(os.getenv("RENDER_CACHE_MB","64"))
+    render_cache_disk_mb: int = int(os.getenv("RENDER_CACHE_DISK_MB","512"))
+    metrics_public: bool = _bool(os.getenv("METRICS_PUBLIC"), False)
+    run_mode: str = os.getenv("RUN_MODE","all")  # all | api | bot
+    prewarm: bool = _bool(os.getenv("PREWARM"), True)
+    bot_mode: str = os.getenv("BOT_MODE","polling")  # polling | webhook
+    webhook_url: str = os.getenv("WEBHOOK_URL","")  # public base URL; empty = register the webhook yourself
+    webhook_path: str = os.getenv("WEBHOOK_PATH","/telegram/webhook")
+    webhook_secret: str = os.getenv("WEBHOOK_SECRET","")  # empty = derived from BOT_TOKEN
 
     def __post_init__(self):
         if self.admin_ids is None:
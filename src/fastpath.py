@@ -0,0 +1,421 @@
+from __future__ import annotations
+import hashlib, io, os, re
+from dataclasses import dataclass
+from typing import Optional
+
+# Browserless renderer for simple Markdown: walks the markdown-it token stream
+# and draws it with Pillow, following the box model Chromium applies to
+# assets/<theme>.css (8px body margin, article padding, 16px/1.6 text,
+# 1em paragraph margins, 40px list indent, collapsing vertical margins).
+# Paragraphs, headings, lists, bold/italic, links and inline code are drawn
+# here; any other token, or a character without a glyph in the configured
+# fonts (emoji, for instance), makes render() return None so the caller falls
+# back to the browser.
+
+FAST_VERSION = "1"  # bump when the layout changes so cached images are not reused
+
+_FONT_DIRS = ("/usr/share/fonts/truetype", "/usr/share/fonts/opentype", "/usr/local/share/fonts")
+# Chromium maps Helvetica/Arial to Liberation on Linux; DejaVu covers the gaps
+# and the CJK fonts come last, as in fontconfig's fallback order.
+FONT_CANDIDATES = {
+    "regular": ["liberation/LiberationSans-Regular.ttf", "dejavu/DejaVuSans.ttf"],
+    "bold": ["liberation/LiberationSans-Bold.ttf", "dejavu/DejaVuSans-Bold.ttf"],
+    "italic": ["liberation/LiberationSans-Italic.ttf", "dejavu/DejaVuSans-Oblique.ttf"],
+    "bold_italic": ["liberation/LiberationSans-BoldItalic.ttf", "dejavu/DejaVuSans-BoldOblique.ttf"],
+    "mono": ["liberation/LiberationMono-Regular.ttf", "dejavu/DejaVuSansMono.ttf"],
+}
+CJK_CANDIDATES = [
+    "wqy/wqy-zenhei.ttc", "noto/NotoSansCJK-Regular.ttc", "noto-cjk/NotoSansCJK-Regular.ttc",
+    "droid/DroidSansFallbackFull.ttf",
+]
+
+BLOCK_TOKENS = {
+    "paragraph_open", "paragraph_close", "heading_open", "heading_close", "inline",
+    "bullet_list_open", "bullet_list_close", "ordered_list_open", "ordered_list_close",
+    "list_item_open", "list_item_close",
+}
+INLINE_TOKENS = {
+    "text", "softbreak", "hardbreak", "strong_open", "strong_close", "em_open", "em_close",
+    "code_inline", "link_open", "link_close",
+}
+HEADING_SCALE = {"h1": 2.0, "h2": 1.5, "h3": 1.25, "h4": 1.0, "h5": 0.875, "h6": 0.85}
+
+_CJK = "\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef\u3000-\u303f"
+_PIECES = re.compile(rf"\s+|[{_CJK}]|[^\s{_CJK}]+")  # words, single CJK characters, whitespace
+# Chromium draws these with a colour emoji font even when a text font has a glyph
+_EMOJI = re.compile("[\U0001f000-\U0001faff\ufe0f\u200d]")
+
+def _find_font(rel: str) -> Optional[str]:
+    for d in _FONT_DIRS:
+        path = os.path.join(d, rel)
+        if os.path.exists(path):
+            return path
+    return None
+
+@dataclass(frozen=True)
+class FastStyle:
+    color: str = "#24292f"
+    background: str = "white"
+    page: str = "white"
+    code_background: str = "#f6f8fa"
+    link: str = "#0969da"
+    font_size: float = 16.0
+    line_height: float = 1.6
+    padding: int = 24
+
+    @classmethod
+    def from_css(cls, css: str) -> "FastStyle":
+        # Only the handful of properties the fast path draws with
+        def rule(selector: str) -> str:
+            m = re.search(rf"(?<![\w.#-]){re.escape(selector)}\s*\{{([^}}]*)\}}", css)
+            return m.group(1) if m else ""
+
+        def prop(block: str, name: str) -> Optional[str]:
+            m = re.search(rf"(?:^|[;\s]){name}\s*:\s*([^;]+)", block)
+            return m.group(1).strip() if m else None
+
+        def px(value: Optional[str], default: float) -> float:
+            m = re.match(r"([\d.]+)(px)?$", value or "")
+            return float(m.group(1)) if m else default
+
+        d = cls()
+        body, code, link, page = rule(".markdown-body"), rule(".markdown-body code"), rule(".markdown-body a"), rule("body")
+        background = prop(body, "background") or prop(body, "background-color") or d.background
+        return cls(
+            color=prop(body, "color") or d.color,
+            background=background,
+            page=prop(page, "background") or prop(page, "background-color") or d.page,
+            code_background=prop(code, "background-color") or prop(code, "background") or d.code_background,
+            link=prop(link, "color") or d.link,
+            font_size=px(prop(body, "font-size"), d.font_size),
+            line_height=px(prop(body, "line-height"), d.line_height),
+            padding=int(px(prop(body, "padding"), d.padding)),
+        )
+
+class _Unsupported(Exception):
+    pass
+
+class FastRenderer:
+    def __init__(self, themes: dict[str, str], extra_fonts: tuple[str, ...] = ()):
+        self.styles = {name: FastStyle.from_css(css) for name, css in themes.items()}
+        extra = [p for p in extra_fonts if os.path.exists(p)]
+        cjk = [p for p in map(_find_font, CJK_CANDIDATES) if p]
+        self.paths: dict[str, list[str]] = {}
+        for kind, rels in FONT_CANDIDATES.items():
+            self.paths[kind] = [p for p in map(_find_font, rels) if p] + extra + cjk
+        self.paths["mono"] += [p for p in self.paths["regular"] if p not in self.paths["mono"]]
+        digest = hashlib.sha256("\0".join([FAST_VERSION, *(p for k in sorted(self.paths) for p in self.paths[k])]).encode())
+        self.version = digest.hexdigest()[:16]
+        self._fonts: dict[tuple[str, int], object] = {}
+        self._glyphs: dict[tuple[str, str], bool] = {}
+        self._notdef: dict[str, bytes] = {}
+
+    @classmethod
+    def from_assets(cls, assets_dir, extra_fonts: tuple[str, ...] = ()) -> "FastRenderer":
+        themes = {f.stem: f.read_text(encoding="utf-8") for f in sorted(assets_dir.glob("*.css"))}
+        return cls(themes, extra_fonts)
+
+    @property
+    def available(self) -> bool:
+        return bool(self.paths["regular"])
+
+    # ---------- Fonts ----------
+    def _font(self, path: str, size: int):
+        font = self._fonts.get((path, size))
+        if font is None:
+            from PIL import ImageFont
+            font = self._fonts[path, size] = ImageFont.truetype(path, size)
+        return font
+
+    def _glyph_image(self, font, ch: str) -> bytes:
+        from PIL import Image, ImageDraw
+        left, top, right, bottom = font.getbbox(ch)
+        img = Image.new("L", (max(1, right - left), max(1, bottom - top)))
+        ImageDraw.Draw(img).text((-left, -top), ch, font=font, fill=255)
+        return img.tobytes() + repr(img.size).encode()
+
+    def _has_glyph(self, path: str, ch: str) -> bool:
+        # Pillow has no coverage query; a missing glyph draws as .notdef
+        known = self._glyphs.get((path, ch))
+        if known is None:
+            font = self._font(path, 32)
+            notdef = self._notdef.get(path)
+            if notdef is None:
+                notdef = self._notdef[path] = self._glyph_image(font, "\U0010fffd")
+            known = self._glyphs[path, ch] = self._glyph_image(font, ch) != notdef
+        return known
+
+    def _runs(self, text: str, kind: str, size: int) -> list[tuple[str, object]]:
+        # Split text into (chunk, font) runs using the first font with each glyph
+        runs: list[tuple[str, object]] = []
+        paths = self.paths[kind]
+        for ch in text:
+            if _EMOJI.match(ch):
+                raise _Unsupported(ch)
+            for path in paths:
+                if ch.isspace() or self._has_glyph(path, ch):
+                    break
+            else:
+                raise _Unsupported(ch)
+            font = self._font(path, size)
+            if runs and runs[-1][1] is font:
+                runs[-1] = (runs[-1][0] + ch, font)
+            else:
+                runs.append((ch, font))
+        return runs
+
+    # ---------- Entry points ----------
+    def supports(self, tokens, theme: str) -> bool:
+        if not self.available or theme not in self.styles:
+            return False
+        for tok in tokens:
+            if tok.type not in BLOCK_TOKENS:
+                return False
+            if tok.type == "inline" and any(child.type not in INLINE_TOKENS for child in tok.children or ()):
+                return False
+        return True
+
+    def render(
+        self, tokens, *, width: int, theme: str, fmt: str = "png", quality: int = 85, max_height: int = 0,
+    ) -> Optional[bytes]:
+        # None as well when the page would be taller than `max_height` (0 = no limit)
+        if not self.supports(tokens, theme):
+            return None
+        try:
+            layout = _Layout(self, self.styles[theme], width)
+            layout.blocks(tokens)
+        except _Unsupported:
+            return None
+        if max_height and layout.height > max_height:
+            return None
+        return layout.draw(fmt, quality)
+
+class _Layout:
+    BODY_MARGIN = 8
+    LIST_INDENT = 40
+    CODE_PAD = 4
+
+    def __init__(self, fr: FastRenderer, style: FastStyle, width: int):
+        self.fr = fr
+        self.style = style
+        self.width = width
+        self.x0 = self.BODY_MARGIN + style.padding
+        self.right = width - self.BODY_MARGIN - style.padding
+        self.y = float(self.BODY_MARGIN + style.padding)
+        self.margin = 0.0  # pending collapsed vertical margin
+        self.ops: list[tuple] = []
+        self.indent = 0
+        self.lists: list[list] = []  # [ordered, next number, depth]
+        self.marker: Optional[tuple] = None
+
+    def _advance_margin(self, m: float) -> None:
+        self.margin = max(self.margin, m)
+
+    def _flush_margin(self) -> None:
+        self.y += self.margin
+        self.margin = 0.0
+
+    # ---------- Blocks ----------
+    def blocks(self, tokens) -> None:
+        fs = self.style.font_size
+        heading: Optional[str] = None
+        hidden_para = False
+        for tok in tokens:
+            t = tok.type
+            if t == "paragraph_open":
+                hidden_para = tok.hidden
+                if not hidden_para:
+                    self._advance_margin(fs)
+            elif t == "paragraph_close":
+                if not hidden_para:
+                    self._advance_margin(fs)
+            elif t == "heading_open":
+                heading = tok.tag
+                self._advance_margin(fs * HEADING_SCALE[heading] * 1.25)
+            elif t == "heading_close":
+                self._advance_margin(fs * HEADING_SCALE[heading] * 0.6)
+                heading = None
+            elif t in ("bullet_list_open", "ordered_list_open"):
+                if not self.lists:
+                    self._advance_margin(fs)  # nested lists have no margins
+                start = int(tok.attrGet("start") or 1) if t == "ordered_list_open" else 0
+                self.lists.append([t == "ordered_list_open", start, len(self.lists)])
+                self.indent += self.LIST_INDENT
+            elif t in ("bullet_list_close", "ordered_list_close"):
+                self.lists.pop()
+                self.indent -= self.LIST_INDENT
+                if not self.lists:
+                    self._advance_margin(fs)
+            elif t == "list_item_open":
+                ordered, number, depth = self.lists[-1]
+                self.marker = ("number", f"{number}.") if ordered else ("bullet", depth)
+                self.lists[-1][1] += 1
+            elif t == "list_item_close":
+                if self.marker is not None:  # empty item: Chromium still gives it a line
+                    self._flush_margin()
+                    self._draw_marker(self.y + (fs * self.style.line_height + fs * 0.8) / 2)
+                    self.y += fs * self.style.line_height
+                    self.marker = None
+            elif t == "inline":
+                if heading:
+                    size = round(fs * HEADING_SCALE[heading])
+                    self.inline(tok.children or [], size, 1.25, bold=True)
+                else:
+                    self.inline(tok.children or [], round(fs), self.style.line_height)
+
+    def _draw_marker(self, baseline: float) -> None:
+        kind, value = self.marker
+        fs = self.style.font_size
+        x = self.x0 + self.indent
+        if kind == "number":
+            font = self.fr._runs(value, "regular", round(fs))[0][1]
+            w = font.getlength(value)
+            self.ops.append(("text", x - w - fs * 0.3, baseline, value, font, self.style.color))
+        else:
+            r = fs * 0.17
+            cx, cy = x - fs * 0.9, baseline - fs * 0.32
+            shape = ("disc", "circle", "square")[min(value, 2)]
+            self.ops.append((shape, cx - r, cy - r, cx + r, cy + r, self.style.color))
+
+    # ---------- Inline ----------
+    def inline(self, children, size: int, line_height: float, bold: bool = False) -> None:
+        style = self.style
+        pieces: list = []  # (text, kind, color, code_span) or None for a hard break
+        strong, em, link, span = int(bold), 0, 0, 0
+        for child in children:
+            t = child.type
+            if t in ("text", "code_inline"):
+                code = t == "code_inline"
+                if code:
+                    span += 1
+                    kind = "mono"
+                else:
+                    kind = ("bold_italic" if em else "bold") if strong else ("italic" if em else "regular")
+                color = style.link if link else style.color
+                for piece in _PIECES.findall(child.content):
+                    pieces.append((" " if piece.isspace() else piece, kind, color, span if code else 0))
+            elif t == "softbreak":
+                pieces.append((" ", "regular", style.color, 0))
+            elif t == "hardbreak":
+                pieces.append(None)
+            elif t == "strong_open":
+                strong += 1
+            elif t == "strong_close":
+                strong -= 1
+            elif t == "em_open":
+                em += 1
+            elif t == "em_close":
+                em -= 1
+            elif t == "link_open":
+                link += 1
+            elif t == "link_close":
+                link -= 1
+        self._flush_margin()
+        self._lines(pieces, size, size * line_height)
+
+    def _lines(self, pieces: list, size: int, line_px: float) -> None:
+        avail = self.right - (self.x0 + self.indent)
+        line: list[tuple] = []  # (x, text, font, color, span)
+        x = 0.0
+        last_span = 0
+
+        def flush():
+            nonlocal line, x
+            while line and line[-1][1] == " ":
+                line.pop()
+            self._emit(line, size, line_px)
+            line, x = [], 0.0
+
+        def place(text: str, kind: str, color: str, span: int):
+            nonlocal x, last_span
+            pad_l = self.CODE_PAD if span and span != last_span else 0
+            runs = self.fr._runs(text, kind, size)
+            w = pad_l + sum(font.getlength(chunk) for chunk, font in runs)
+            if span:
+                w += self.CODE_PAD  # provisional right padding, taken back if the span continues
+            if line and x + w > avail:
+                flush()
+                if text == " ":
+                    return
+            elif text == " " and not line:
+                return
+            x += pad_l
+            for chunk, font in runs:
+                line.append((x, chunk, font, color, span))
+                x += font.getlength(chunk)
+            last_span = span
+
+        for piece in pieces:
+            if piece is None:
+                flush()
+                continue
+            text, kind, color, span = piece
+            if last_span and span != last_span and line and line[-1][4] == last_span:
+                x += self.CODE_PAD  # right padding of the code span that just ended
+            if text != " " and self._width(text, kind, size) > avail:
+                for ch in text:  # a single word wider than the line: break anywhere
+                    place(ch, kind, color, span)
+            else:
+                place(text, kind, color, span)
+        flush()
+
+    def _width(self, text: str, kind: str, size: int) -> float:
+        return sum(font.getlength(chunk) for chunk, font in self.fr._runs(text, kind, size))
+
+    def _emit(self, line: list, size: int, line_px: float) -> None:
+        primary = self.fr._font(self.fr.paths["regular"][0], size)
+        ascent, descent = primary.getmetrics()
+        baseline = self.y + (line_px - ascent - descent) / 2 + ascent
+        if self.marker is not None:
+            self._draw_marker(baseline)
+            self.marker = None
+        x0 = self.x0 + self.indent
+        spans: dict[int, list[float]] = {}
+        for x, chunk, font, color, span in line:
+            if span:
+                box = spans.setdefault(span, [x, x])
+                box[1] = x + font.getlength(chunk)
+        for left, right in spans.values():
+            self.ops.append((
+                "code", x0 + left - self.CODE_PAD, baseline - ascent - 2,
+                x0 + right + self.CODE_PAD, baseline + descent + 2, self.style.code_background,
+            ))
+        for x, chunk, font, color, span in line:
+            self.ops.append(("text", x0 + x, baseline, chunk, font, color))
+        self.y += line_px
+
+    # ---------- Raster ----------
+    @property
+    def height(self) -> int:
+        return round(self.y + self.margin + self.style.padding + self.BODY_MARGIN)
+
+    def draw(self, fmt: str, quality: int) -> bytes:
+        from PIL import Image, ImageDraw
+        height = self.height
+        img = Image.new("RGB", (self.width, height), self.style.page)
+        d = ImageDraw.Draw(img)
+        m = self.BODY_MARGIN
+        d.rectangle((m, m, self.width - m - 1, height - m - 1), fill=self.style.background)
+        for op in self.ops:
+            kind = op[0]
+            if kind == "text":
+                _, x, y, text, font, color = op
+                d.text((x, y), text, font=font, fill=color, anchor="ls")
+            elif kind == "code":
+                d.rounded_rectangle(op[1:5], radius=4, fill=op[5])
+            elif kind == "disc":
+                d.ellipse(op[1:5], fill=op[5])
+            elif kind == "circle":
+                d.ellipse(op[1:5], outline=op[5])
+            elif kind == "square":
+                d.rectangle(op[1:5], fill=op[5])
+        out = io.BytesIO()
+        if fmt == "jpeg":
+            img.save(out, format="JPEG", quality=quality)
+        elif fmt == "webp":
+            img.save(out, format="WEBP", quality=quality, method=4)
+        elif fmt == "png8":
+            img.quantize(colors=256).save(out, format="PNG", optimize=True)
+        else:
+            img.save(out, format="PNG")
+        return out.getvalue()
@@ -0,0 +1,248 @@
+from __future__ import annotations
+import asyncio, secrets, shutil, time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Hashable, Optional
+
+# Asynchronous render jobs behind POST /jobs. A job is an in-memory record
+# plus a task that runs the render; clients poll for the status and fetch
+# the image later. Finished results live in memory up to `memory_bytes`;
+# the oldest are then moved to `disk_dir` (if `disk_bytes` > 0) or dropped,
+# which marks the job "expired". Finished jobs are forgotten `ttl` seconds
+# after they complete. Each owner has at most `per_owner` jobs waiting for
+# the scheduler at a time, the rest wait here as "queued", so a client can
+# submit far more jobs than the scheduler would queue for it.
+
+class JobsFull(Exception):
+    pass
+
+class _Job:
+    __slots__ = (
+        "id", "owner", "status", "media_type", "created_at", "started_at", "finished_at",
+        "error", "size", "data", "path", "task",
+    )
+
+    def __init__(self, job_id: str, owner: Hashable, media_type: str):
+        self.id = job_id
+        self.owner = owner
+        self.status = "queued"  # queued | running | done | failed | expired
+        self.media_type = media_type
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.size = 0
+        self.data: Optional[bytes] = None
+        self.path: Optional[Path] = None
+        self.task: Optional[asyncio.Task] = None
+
+class JobStore:
+    def __init__(
+        self,
+        ttl: float = 3600,
+        max_jobs: int = 1000,
+        memory_bytes: int = 64 * 1024 * 1024,
+        disk_dir: str | None = None,
+        disk_bytes: int = 0,
+        per_owner: int = 5,
+    ):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir and disk_bytes > 0 else None
+        self.per_owner = max(1, per_owner)
+        self._jobs: dict[str, _Job] = {}
+        self._in_memory: OrderedDict[str, int] = OrderedDict()  # job id -> size, oldest first
+        self._on_disk: OrderedDict[str, int] = OrderedDict()
+        self._mem_used = 0
+        self._disk_used = 0
+        self._gates: dict[Hashable, list] = {}  # owner -> [semaphore, jobs not finished]
+        self._sweeper: Optional[asyncio.Task] = None
+        self.submitted = 0
+        self.expired = 0
+        if self.disk_dir is not None:
+            # Job ids live in memory only, so results from an earlier run are unreachable
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+    # ---------- Submit / query ----------
+    def submit(self, render: Callable[[], Awaitable[bytes]], *, owner: Hashable, media_type: str) -> _Job:
+        if len(self._jobs) >= self.max_jobs:
+            self._sweep()
+        if len(self._jobs) >= self.max_jobs:
+            raise JobsFull(f"too many jobs (limit {self.max_jobs})")
+        job = _Job(secrets.token_urlsafe(16), owner, media_type)
+        self._jobs[job.id] = job
+        gate = self._gates.get(owner)
+        if gate is None:
+            gate = self._gates[owner] = [asyncio.Semaphore(self.per_owner), 0]
+        gate[1] += 1
+        job.task = asyncio.create_task(self._run(job, render, gate))
+        self.submitted += 1
+        if self._sweeper is None and self.ttl > 0:
+            self._sweeper = asyncio.create_task(self._sweep_forever())
+        return job
+
+    def get(self, job_id: str) -> Optional[_Job]:
+        job = self._jobs.get(job_id)
+        if job is not None and self._is_stale(job, time.time()):
+            self._forget(job)
+            return None
+        return job
+
+    async def result(self, job: _Job) -> Optional[bytes]:
+        if job.data is not None:
+            return job.data
+        if job.path is not None:
+            try:
+                return await asyncio.to_thread(job.path.read_bytes)
+            except OSError:
+                return None
+        return None
+
+    def cancel(self, job: _Job) -> None:
+        if job.task is not None and not job.task.done():
+            job.task.cancel()
+        self._forget(job)
+
+    def describe(self, job: _Job) -> dict:
+        expires = job.finished_at + self.ttl if job.finished_at is not None and self.ttl > 0 else None
+        return {
+            "id": job.id,
+            "status": job.status,
+            "created_at": int(job.created_at),
+            "started_at": int(job.started_at) if job.started_at else None,
+            "finished_at": int(job.finished_at) if job.finished_at else None,
+            "expires_at": int(expires) if expires else None,
+            "media_type": job.media_type,
+            "bytes": job.size or None,
+            "error": job.error,
+        }
+
+    # ---------- Running ----------
+    async def _run(self, job: _Job, render: Callable[[], Awaitable[bytes]], gate: list) -> None:
+        try:
+            async with gate[0]:
+                job.status = "running"
+                job.started_at = time.time()
+                data = await render()
+            await self._keep(job, data)
+            if job.status != "expired":  # _keep drops a result that fits nowhere
+                job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "failed"
+            job.error = "cancelled"
+            raise
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e) or type(e).__name__
+        finally:
+            job.finished_at = time.time()
+            gate[1] -= 1
+            if gate[1] == 0 and self._gates.get(job.owner) is gate:
+                del self._gates[job.owner]
+
+    async def _keep(self, job: _Job, data: bytes) -> None:
+        job.size = len(data)
+        if job.size <= self.memory_bytes:
+            job.data = data
+            self._in_memory[job.id] = job.size
+            self._mem_used += job.size
+        else:
+            await self._spill(job, data)
+        while self._mem_used > self.memory_bytes and self._in_memory:
+            old_id, size = self._in_memory.popitem(last=False)
+            self._mem_used -= size
+            old = self._jobs.get(old_id)
+            if old is not None and old.data is not None:
+                data, old.data = old.data, None
+                await self._spill(old, data)
+
+    async def _spill(self, job: _Job, data: bytes) -> None:
+        if self.disk_dir is None or job.size > self.disk_bytes:
+            self._expire(job)
+            return
+        path = self.disk_dir / f"{job.id}.bin"
+        try:
+            await asyncio.to_thread(path.write_bytes, data)
+        except OSError as e:
+            print(f"[jobs] disk spill failed: {e}")
+            self._expire(job)
+            return
+        job.path = path
+        self._on_disk[job.id] = job.size
+        self._disk_used += job.size
+        while self._disk_used > self.disk_bytes and self._on_disk:
+            old_id, _ = next(iter(self._on_disk.items()))
+            old = self._jobs.get(old_id)
+            if old is None:
+                self._drop_file(old_id)
+            else:
+                self._expire(old)
+
+    # ---------- Eviction ----------
+    def _drop_file(self, job_id: str) -> None:
+        size = self._on_disk.pop(job_id, None)
+        if size is None:
+            return
+        self._disk_used -= size
+        try:
+            (self.disk_dir / f"{job_id}.bin").unlink()
+        except OSError:
+            pass
+
+    def _drop_result(self, job: _Job) -> None:
+        size = self._in_memory.pop(job.id, None)
+        if size is not None:
+            self._mem_used -= size
+        job.data = None
+        if job.path is not None:
+            self._drop_file(job.id)
+            job.path = None
+
+    def _expire(self, job: _Job) -> None:
+        # Result evicted before its TTL; the status stays queryable until then
+        self._drop_result(job)
+        job.status = "expired"
+        self.expired += 1
+
+    def _forget(self, job: _Job) -> None:
+        self._drop_result(job)
+        self._jobs.pop(job.id, None)
+
+    def _is_stale(self, job: _Job, now: float) -> bool:
+        return self.ttl > 0 and job.finished_at is not None and now - job.finished_at > self.ttl
+
+    def _sweep(self) -> None:
+        now = time.time()
+        for job in [j for j in self._jobs.values() if self._is_stale(j, now)]:
+            self._forget(job)
+
+    async def _sweep_forever(self) -> None:
+        while True:
+            await asyncio.sleep(min(60.0, max(1.0, self.ttl / 2)))
+            self._sweep()
+
+    async def close(self) -> None:
+        tasks = [j.task for j in self._jobs.values() if j.task is not None and not j.task.done()]
+        if self._sweeper is not None:
+            tasks.append(self._sweeper)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.disk_dir is not None:
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+
+    def stats(self) -> dict:
+        by_status: dict[str, int] = {}
+        for job in self._jobs.values():
+            by_status[job.status] = by_status.get(job.status, 0) + 1
+        return {
+            "jobs": len(self._jobs),
+            "by_status": by_status,
+            "submitted": self.submitted,
+            "expired": self.expired,
+            "memory_bytes": self._mem_used,
+            "disk_bytes": self._disk_used,
+        }
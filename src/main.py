@@ -1,20 +1,36 @@
 from __future__ import annotations
-import asyncio, uvicorn, os
+import asyncio
 from .config import cfg
-from .api_server import app
-from .bot import BotApp
+from . import services
+
+# FastAPI/uvicorn and python-telegram-bot are imported only by the runner
+# that needs them, so RUN_MODE=api or RUN_MODE=bot skips the other stack.
 
 async def run_api():
+    import uvicorn
+    from .api_server import app
     config = uvicorn.Config(app, host=cfg.api_host, port=cfg.api_port, log_level="info")
     server = uvicorn.Server(config)
     await server.serve()
 
 async def run_bot():
+    from .bot import BotApp
     bot = BotApp()
-    await bot.run_polling()
+    await bot.run()
+
+RUNNERS = {"all": (run_api, run_bot), "api": (run_api,), "bot": (run_bot,)}
 
 async def main():
-    await asyncio.gather(run_api(), run_bot())
+    runners = RUNNERS.get(cfg.run_mode)
+    if runners is None:
+        raise SystemExit(f"RUN_MODE must be one of {', '.join(RUNNERS)}, got {cfg.run_mode!r}")
+    if cfg.bot_mode == "webhook" and cfg.run_mode == "bot":
+        raise SystemExit("BOT_MODE=webhook receives updates through the API server; use RUN_MODE=all")
+    services.start_warmup()
+    try:
+        await asyncio.gather(*(run() for run in runners))
+    finally:
+        await services.shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())
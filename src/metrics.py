@@ -0,0 +1,90 @@
+from __future__ import annotations
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Prometheus instrumentation. Hot paths only touch pre-bound histogram and
+# counter children (a lock and a few float adds); queue depth, in-flight
+# renders and cache counters are read from the live objects at scrape time.
+
+STAGES = ("queue", "parse", "acquire", "set_content", "measure", "screenshot", "encode", "rasterize", "upload")
+SOURCES = ("dm", "group", "command", "channel", "plugin", "api", "api_batch", "api_jobs")
+RESULTS = ("success", "failed", "rejected", "rate_limited")
+
+_stage_seconds = Histogram(
+    "md2img_render_stage_seconds", "Time spent in each render stage", ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+_requests = Counter("md2img_requests_total", "Render requests by source and result", ["source", "result"])
+
+_STAGE_CHILDREN = {stage: _stage_seconds.labels(stage) for stage in STAGES}
+_REQUEST_CHILDREN = {(src, res): _requests.labels(src, res) for src in SOURCES for res in RESULTS}
+
+def observe_stages(stages: dict[str, float]) -> None:
+    for stage, seconds in stages.items():
+        child = _STAGE_CHILDREN.get(stage)
+        if child is not None:
+            child.observe(seconds)
+
+def observe(stage: str, seconds: float) -> None:
+    _STAGE_CHILDREN[stage].observe(seconds)
+
+def count(source: str, result: str) -> None:
+    _REQUEST_CHILDREN[source, result].inc()
+
+class _LiveCollector:
+    # Reads renderer/limiter state only when /metrics is scraped
+    def __init__(self, renderer, limiter):
+        self.renderer = renderer
+        self.limiter = limiter
+
+    def collect(self):
+        r = self.renderer
+        sched = r.scheduler.stats()
+        queued = GaugeMetricFamily("md2img_render_queue_depth", "Renders waiting for a slot", labels=["priority"])
+        for priority, n in sched["queued_by_priority"].items():
+            queued.add_metric([priority], n)
+        yield queued
+        yield GaugeMetricFamily("md2img_renders_in_flight", "Renders holding a slot", value=sched["active"])
+        yield GaugeMetricFamily("md2img_render_concurrency", "Render slots", value=sched["concurrency"])
+        yield CounterMetricFamily("md2img_render_rejected", "Renders rejected by the scheduler", value=sched["rejected"])
+        yield CounterMetricFamily("md2img_render_coalesced", "Renders served by an identical in-flight render", value=r.coalesced)
+        yield CounterMetricFamily("md2img_fast_renders", "Renders drawn by the browserless fast path", value=r.fast_renders)
+        if r.cache is not None:
+            cache = r.cache.stats()
+            yield CounterMetricFamily("md2img_render_cache_hits", "Render cache hits", value=cache["hits"])
+            yield CounterMetricFamily("md2img_render_cache_misses", "Render cache misses", value=cache["misses"])
+            size = GaugeMetricFamily("md2img_render_cache_bytes", "Render cache size", labels=["tier"])
+            size.add_metric(["memory"], cache["memory_bytes"])
+            size.add_metric(["disk"], cache["disk_bytes"])
+            yield size
+        interventions = CounterMetricFamily(
+            "md2img_browser_interventions", "Browser supervisor actions (timeouts, crashes, recycles)", labels=["kind"],
+        )
+        counters = r.workers.browser if r.workers is not None else r.pool.counters
+        for kind, n in counters.items():
+            interventions.add_metric([kind], n)
+        yield interventions
+        if r.workers is None:
+            yield GaugeMetricFamily("md2img_browsers", "Live Chromium browsers", value=r.pool.stats()["browsers"])
+        if r.workers is not None:
+            workers = r.workers.stats()
+            yield GaugeMetricFamily("md2img_workers_connected", "Connected render workers", value=workers["connected"])
+            yield GaugeMetricFamily("md2img_worker_jobs_in_flight", "Jobs sent to render workers", value=workers["in_flight"])
+            yield CounterMetricFamily("md2img_worker_restarts", "Render worker restarts", value=workers["restarts"])
+            yield CounterMetricFamily("md2img_worker_kills", "Render workers killed for missing a deadline", value=workers["killed"])
+        limited = CounterMetricFamily("md2img_rate_limited", "Requests refused by a rate limit", labels=["kind"])
+        for kind, bucket in self.limiter.buckets.items():
+            limited.add_metric([kind], bucket.limited)
+        yield limited
+
+_watched: _LiveCollector | None = None
+
+def watch(renderer, limiter) -> None:
+    global _watched
+    if _watched is not None:
+        REGISTRY.unregister(_watched)
+    _watched = _LiveCollector(renderer, limiter)
+    REGISTRY.register(_watched)
+
+def render_latest() -> tuple[bytes, str]:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -1,8 +1,10 @@
 from __future__ import annotations
-import io
-from telegram import InputFile, Update
+from telegram import Update
 from telegram.ext import ContextTypes, MessageHandler, filters
 
+from ..scheduler import Priority, SchedulerBusy
+from .. import metrics
+
 def register(app, renderer, storage, botapp):
     async def handle_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
         post = update.channel_post
@@ -11,15 +13,25 @@ def register(app, renderer, storage, botapp):
         text = post.text or post.caption or ""
         if not text.strip():
             return
+        if botapp.limiter.hit("chat", post.chat_id):
+            storage.inc_stat("rate_limited")
+            metrics.count("plugin", "rate_limited")
+            return
         try:
-            png = await renderer.render_markdown(text)
-            bio = io.BytesIO(png); bio.name = "render.png"
-            await post.reply_document(document=InputFile(bio), caption="📸 自动转换")
+            await botapp.render_and_send(post, text, caption="📸 自动转换", owner=("chat", post.chat_id), priority=Priority.CHANNEL)
             storage.inc_stat("total_requests")
             storage.inc_stat("render_success")
+            metrics.count("plugin", "success")
+        except SchedulerBusy as e:
+            storage.inc_stat("total_requests")
+            storage.inc_stat("render_rejected")
+            metrics.count("plugin", "rejected")
+            print(f"[channel_autoconvert] skipped: {e}")
         except Exception as e:
             storage.inc_stat("total_requests")
             storage.inc_stat("render_failed")
+            metrics.count("plugin", "failed")
             print(f"[channel_autoconvert] error: {e}")
 
     app.add_handler(MessageHandler(filters.UpdateType.CHANNEL_POST, handle_channel_post), group=1)
+    botapp.disable_channel_fallback()
@@ -0,0 +1,139 @@
+from __future__ import annotations
+import asyncio, hashlib, os, sys, threading, time
+from collections import Counter, deque
+from typing import Optional
+
+# Production diagnostics without restarting under a profiler: a stdlib
+# sampling profiler run for a bounded window, a dump of the event loop's
+# tasks, and a ring buffer of recent slow renders. Everything here sees only
+# the current process; with RENDER_WORKERS the screenshots themselves happen
+# in the worker processes.
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_profiling = threading.Lock()
+
+class ProfilerBusy(Exception):
+    pass
+
+def _label(code) -> str:
+    path = code.co_filename
+    if path.startswith(_ROOT):
+        path = os.path.relpath(path, _ROOT)
+    else:
+        # site-packages/... or the stdlib: keep the last two components
+        path = "/".join(path.replace("\\", "/").split("/")[-2:])
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+def sample(seconds: float, interval: float = 0.005) -> dict:
+    # Blocking: samples every thread's Python stack (except its own) every
+    # `interval` seconds; run it in a thread. One profile at a time.
+    if not _profiling.acquire(blocking=False):
+        raise ProfilerBusy("a profile is already running")
+    try:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        stacks: Counter[tuple[str, ...]] = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                stacks[tuple(reversed(stack))] += 1
+            samples += 1
+            time.sleep(interval)
+    finally:
+        _profiling.release()
+    own: Counter[str] = Counter()
+    total: Counter[str] = Counter()
+    for stack, n in stacks.items():
+        own[stack[-1]] += n
+        for fn in set(stack[1:]):
+            total[fn] += n
+    return {"seconds": seconds, "interval": interval, "samples": samples, "stacks": stacks, "own": own, "total": total}
+
+def collapsed(profile: dict) -> str:
+    # "thread;outer;...;inner count" lines, the input format of flamegraph.pl and speedscope
+    return "".join(f"{';'.join(stack)} {n}\n" for stack, n in profile["stacks"].most_common())
+
+def summary(profile: dict, top: int = 50) -> dict:
+    return {
+        "seconds": profile["seconds"],
+        "interval": profile["interval"],
+        "samples": profile["samples"],
+        "own": [{"function": fn, "samples": n} for fn, n in profile["own"].most_common(top)],
+        "total": [{"function": fn, "samples": n} for fn, n in profile["total"].most_common(top)],
+    }
+
+def dump_tasks(limit: int = 20) -> list[dict]:
+    # Every task of the running loop with where it is suspended, innermost frame last
+    out = []
+    for task in asyncio.all_tasks():
+        coro = task.get_coro()
+        out.append({
+            "name": task.get_name(),
+            "coro": getattr(coro, "__qualname__", repr(coro)),
+            "done": task.done(),
+            "stack": [f"{_label(f.f_code)} line {f.f_lineno}" for f in task.get_stack(limit=limit)],
+        })
+    out.sort(key=lambda t: t["name"])
+    return out
+
+# Renders slower than `threshold_ms` end to end (queue wait included), newest
+# first. Each entry carries enough to find or replay the input offline: its
+# size and sha256, the output settings, the page height and the stage timings;
+# the Markdown itself only when `capture_input` is set.
+class SlowRenderLog:
+    def __init__(self, threshold_ms: float = 1000, capacity: int = 50, capture_input: bool = False):
+        self.threshold_ms = threshold_ms
+        self.capture_input = capture_input
+        self._entries: deque[dict] = deque(maxlen=max(1, capacity))
+        self.recorded = 0
+
+    def is_slow(self, seconds: float) -> bool:
+        return 0 < self.threshold_ms <= seconds * 1000
+
+    def record(
+        self,
+        md: str,
+        seconds: float,
+        stages: dict[str, float],
+        *,
+        engine: str,
+        width: int,
+        theme: Optional[str],
+        fmt: str,
+        height: Optional[int] = None,
+        tiles: Optional[int] = None,
+        error: Optional[str] = None,
+    ) -> None:
+        entry = {
+            "at": int(time.time()),
+            "total_ms": round(seconds * 1000, 1),
+            "engine": engine,
+            "chars": len(md),
+            "bytes": len(md.encode("utf-8")),
+            "sha256": hashlib.sha256(md.encode("utf-8")).hexdigest(),
+            "width": width,
+            "theme": theme,
+            "format": fmt,
+            "height": height,
+            "tiles": tiles,
+            "stages_ms": {stage: round(s * 1000, 1) for stage, s in stages.items()},
+            "error": error,
+        }
+        if self.capture_input:
+            entry["markdown"] = md
+        self._entries.appendleft(entry)
+        self.recorded += 1
+
+    def entries(self, slowest: bool = False) -> list[dict]:
+        items = list(self._entries)
+        if slowest:
+            items.sort(key=lambda e: e["total_ms"], reverse=True)
+        return items
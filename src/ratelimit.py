@@ -0,0 +1,77 @@
+from __future__ import annotations
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+def parse_rate(spec: str | None) -> Optional[tuple[int, float]]:
+    # "20/60" -> 20 requests per 60 seconds; empty or "0" disables the limit
+    if not spec or not spec.strip() or spec.strip() == "0":
+        return None
+    count, _, period = spec.partition("/")
+    count_i, period_f = int(count), float(period or 60)
+    if count_i <= 0 or period_f <= 0:
+        return None
+    return count_i, period_f
+
+# Classic token bucket per identity: `burst` tokens, refilled at
+# burst/period tokens per second. State is two floats per identity kept in an
+# LRU-bounded dict, so idle identities fall out on their own.
+class TokenBucket:
+    def __init__(self, burst: int, period: float, max_keys: int = 100_000):
+        self.burst = burst
+        self.period = period
+        self.rate = burst / period
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[Hashable, list[float]] = OrderedDict()  # key -> [tokens, updated_at]
+        self.limited = 0
+
+    def _refill(self, bucket: list[float], now: float) -> None:
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+    def take(self, key: Hashable, cost: int = 1) -> float:
+        # Consume `cost` tokens; returns 0 when allowed, else seconds until retry
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [float(self.burst), now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            self._refill(bucket, now)
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0.0
+        self.limited += 1
+        return (cost - bucket[0]) / self.rate
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        throttled = 0
+        for tokens, updated in self._buckets.values():
+            if min(self.burst, tokens + (now - updated) * self.rate) < 1:
+                throttled += 1
+        return {
+            "rate": f"{self.burst}/{self.period:g}s",
+            "tracked": len(self._buckets),
+            "throttled": throttled,
+            "limited_total": self.limited,
+        }
+
+class RateLimiter:
+    def __init__(self, **specs: str | None):
+        self.buckets: dict[str, TokenBucket] = {}
+        for kind, spec in specs.items():
+            rate = parse_rate(spec)
+            if rate:
+                self.buckets[kind] = TokenBucket(*rate)
+
+    def hit(self, kind: str, key: Hashable, cost: int = 1) -> float:
+        bucket = self.buckets.get(kind)
+        return bucket.take(key, cost) if bucket else 0.0
+
+    def stats(self) -> dict:
+        return {kind: b.stats() for kind, b in self.buckets.items()}
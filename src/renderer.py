@@ -1,62 +1,927 @@
 from __future__ import annotations
-import asyncio, base64, os, pathlib, textwrap
-from typing import Optional
+import asyncio, base64, hashlib, io, os, pathlib, re, textwrap, time, weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, asynccontextmanager
+from typing import AsyncIterator, Callable, Hashable, Optional
 from markdown_it import MarkdownIt
-from markdown_it.extensions.front_matter import front_matter_plugin
-from markdown_it.extensions.footnote import footnote_plugin
-from markdown_it.extensions.tasklists import tasklists_plugin
-from markdown_it.extensions.deflist import deflist_plugin
+from mdit_py_plugins.front_matter import front_matter_plugin
+from mdit_py_plugins.footnote import footnote_plugin
+from mdit_py_plugins.tasklists import tasklists_plugin
+from mdit_py_plugins.deflist import deflist_plugin
+
+from .cache import RenderCache
+from .fastpath import FastRenderer
+from .profiling import SlowRenderLog
+from .scheduler import Claim, Priority, RenderScheduler, SchedulerBusy
+from .utils import StageTimer
+from . import metrics
 
 ASSETS_DIR = pathlib.Path(__file__).resolve().parents[1] / "assets"
+DEFAULT_THEME = "github-markdown"
+# Bump whenever the HTML shell below changes so cached renders made with the
+# old template are not served.
+TEMPLATE_VERSION = "2"
+# Strict CSP: no external loads
+CSP = "default-src 'none'; img-src data:; style-src 'self' 'unsafe-inline'; font-src 'self' data:;"
+
+def minify_css(css: str) -> str:
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
+
+# Markdown -> HTML built once and reused: the parser, every stylesheet under
+# assets/ (one theme per file, keyed by file stem) and the page shell around
+# the article are prepared up front, so a render is one parse plus one join.
+class MarkdownPipeline:
+    def __init__(self, themes: dict[str, str], default_theme: str = DEFAULT_THEME):
+        if default_theme not in themes:
+            raise ValueError(f"unknown theme: {default_theme}")
+        self.default_theme = default_theme
+        self.parser = (
+            MarkdownIt("commonmark", {"html": False}) # disallow raw HTML
+            .use(front_matter_plugin)
+            .use(footnote_plugin)
+            .use(tasklists_plugin)
+            .use(deflist_plugin)
+        )
+        self._shells: dict[str, tuple[str, str]] = {}
+        self._versions: dict[str, str] = {}
+        for name, css in themes.items():
+            css = minify_css(css)
+            prefix = (
+                '<!doctype html>\n<html>\n<head>\n<meta charset="utf-8"/>\n'
+                f'<meta http-equiv="Content-Security-Policy" content="{CSP}"/>\n'
+                '<meta name="viewport" content="width=device-width, initial-scale=1"/>\n'
+                f"<style>{css}</style>\n</head>\n<body>\n"
+                '<article class="markdown-body">\n'
+            )
+            suffix = "\n</article>\n</body>\n</html>"
+            self._shells[name] = (prefix, suffix)
+            digest = hashlib.sha256(f"{TEMPLATE_VERSION}\0{prefix}\0{suffix}".encode("utf-8"))
+            self._versions[name] = digest.hexdigest()[:16]
+
+    @classmethod
+    def from_assets(cls, assets_dir: pathlib.Path = ASSETS_DIR, default_theme: str = DEFAULT_THEME) -> "MarkdownPipeline":
+        themes = {f.stem: f.read_text(encoding="utf-8") for f in sorted(assets_dir.glob("*.css"))}
+        return cls(themes, default_theme)
+
+    @property
+    def themes(self) -> list[str]:
+        return list(self._shells)
+
+    def _theme(self, theme: Optional[str]) -> str:
+        theme = theme or self.default_theme
+        if theme not in self._shells:
+            raise ValueError(f"unknown theme: {theme}")
+        return theme
+
+    def version(self, theme: Optional[str] = None) -> str:
+        return self._versions[self._theme(theme)]
+
+    def shell(self, theme: Optional[str] = None) -> str:
+        # The page without content, loaded once per browser page and reused
+        prefix, suffix = self._shells[self._theme(theme)]
+        return prefix + suffix
+
+    def parse(self, md: str) -> tuple[list, dict]:
+        # Tokens plus the env they refer to (footnotes live there)
+        env: dict = {}
+        return self.parser.parse(md.strip("\ufeff"), env), env  # trim BOM if pasted
+
+    def render_tokens(self, parsed: tuple[list, dict]) -> str:
+        tokens, env = parsed
+        return self.parser.renderer.render(tokens, self.parser.options, env)
+
+    def render_body(self, md: str) -> str:
+        return self.render_tokens(self.parse(md))
+
+    def render(self, md: str, theme: Optional[str] = None) -> str:
+        prefix, suffix = self._shells[self._theme(theme)]
+        return "".join((prefix, self.render_body(md), suffix))
+
+_default_pipeline: Optional[MarkdownPipeline] = None
+
+def get_pipeline() -> MarkdownPipeline:
+    global _default_pipeline
+    if _default_pipeline is None:
+        _default_pipeline = MarkdownPipeline.from_assets()
+    return _default_pipeline
+
+def md_to_html(md: str, theme: Optional[str] = None) -> str:
+    return get_pipeline().render(md, theme)
+
+class RenderTimeout(Exception):
+    pass
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+class _Browser:
+    # One Chromium process and the pages opened in it
+    def __init__(self, browser):
+        self.browser = browser
+        self.pages: set = set()
+        self.renders = 0
+        self.rss = 0
+
+# Long-lived Chromium browsers with a fixed set of reusable pages. Browsers are
+# launched on first use; a page that raised is discarded and replaced so a
+# broken tab never gets handed out again. A supervisor task relaunches
+# browsers that died and recycles those past `recycle_after` renders or
+# `max_rss_mb` resident memory: a replacement is launched first, then the old
+# browser is closed once its last page comes back. Every intervention is
+# counted in `counters` and passed to `on_event`.
+class BrowserPool:
+    def __init__(
+        self,
+        browsers: int = 1,
+        pages_per_browser: int = 2,
+        *,
+        recycle_after: int = 0,
+        max_rss_mb: int = 0,
+        check_interval: float = 30.0,
+        on_event: Optional[Callable[[str, int], None]] = None,
+    ):
+        self.browsers = max(1, browsers)
+        self.pages_per_browser = max(1, pages_per_browser)
+        self.recycle_after = recycle_after
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.check_interval = check_interval
+        self.on_event = on_event
+        self.counters = {
+            "timeouts": 0, "page_crashes": 0, "browser_crashes": 0,
+            "recycled_renders": 0, "recycled_rss": 0, "relaunches": 0,
+        }
+        self._pw = None
+        self._slots: list[_Browser] = []   # live browsers handing out pages
+        self._owner: dict = {}             # page -> _Browser, including retiring ones
+        self._idle: Optional[asyncio.Queue] = None
+        self._lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task] = set()
+        self._closing = False
+
+    @property
+    def started(self) -> bool:
+        return self._idle is not None
+
+    def note(self, kind: str) -> None:
+        self.counters[kind] += 1
+        if self.on_event is not None:
+            self.on_event(kind, 1)
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def start(self) -> None:
+        if self._idle is not None:
+            return
+        async with self._lock:
+            if self._idle is not None:
+                return
+            # Playwright is imported lazily to keep import cost low
+            from playwright.async_api import async_playwright
+            self._closing = False
+            self._pw = await async_playwright().start()
+            idle: asyncio.Queue = asyncio.Queue()
+            for _ in range(self.browsers):
+                await self._launch(idle)
+            self._idle = idle
+            if self.check_interval > 0:
+                self._spawn(self._supervise())
+
+    async def close(self) -> None:
+        async with self._lock:
+            self._closing = True
+            for task in list(self._tasks):
+                task.cancel()
+            for slot in set(self._owner.values()) | set(self._slots):
+                try:
+                    await slot.browser.close()
+                except Exception:
+                    pass
+            self._slots.clear()
+            self._owner.clear()
+            if self._pw is not None:
+                await self._pw.stop()
+            self._pw = None
+            self._idle = None
+
+    async def _launch(self, idle: asyncio.Queue) -> _Browser:
+        slot = _Browser(await self._pw.chromium.launch())
+        slot.browser.on("disconnected", lambda _: self._on_disconnected(slot))
+        self._slots.append(slot)
+        for _ in range(self.pages_per_browser):
+            idle.put_nowait(await self._new_page(slot))
+        return slot
+
+    async def _new_page(self, slot: _Browser):
+        page = await slot.browser.new_page()
+        page.on("crash", lambda _: self.note("page_crashes"))
+        slot.pages.add(page)
+        self._owner[page] = slot
+        return page
+
+    def _on_disconnected(self, slot: _Browser) -> None:
+        if not self._closing and slot in self._slots:
+            self.note("browser_crashes")
+            self._spawn(self._retire(slot))
+
+    @asynccontextmanager
+    async def page(self):
+        await self.start()
+        while True:
+            page = await self._idle.get()
+            slot = self._owner.get(page)
+            if slot in self._slots and not page.is_closed():
+                break
+            await self._discard(page)  # left over from a dead or retired browser
+        ok = False
+        try:
+            yield page
+            ok = True
+        finally:
+            slot.renders += 1
+            if slot not in self._slots:
+                await self._discard(page)
+            elif ok:
+                self._idle.put_nowait(page)
+            else:
+                await self._replace(page, slot)
+            if self.recycle_after and slot.renders >= self.recycle_after and slot in self._slots:
+                self.note("recycled_renders")
+                self._spawn(self._retire(slot))
+
+    async def _close_page(self, page) -> bool:
+        try:
+            await asyncio.wait_for(page.close(), timeout=5)
+            return True
+        except Exception:
+            return False
+
+    async def _discard(self, page) -> None:
+        slot = self._owner.pop(page, None)
+        await self._close_page(page)
+        if slot is not None:
+            slot.pages.discard(page)
+            if not slot.pages and slot not in self._slots:
+                try:
+                    await asyncio.wait_for(slot.browser.close(), timeout=10)
+                except Exception:
+                    pass
+
+    async def _replace(self, page, slot: _Browser) -> None:
+        self._owner.pop(page, None)
+        slot.pages.discard(page)
+        # A page that will not close (hung renderer) or a dead browser takes
+        # the whole browser down; _retire launches the replacement.
+        if not await self._close_page(page) or not slot.browser.is_connected():
+            if slot in self._slots:
+                self._spawn(self._retire(slot))
+            return
+        try:
+            self._idle.put_nowait(await self._new_page(slot))
+        except Exception as e:
+            print(f"[browser_pool] failed to replace page: {e}")
+            self._spawn(self._retire(slot))
+
+    async def _retire(self, slot: _Browser) -> None:
+        # Launch the replacement first, then drop the old browser's idle pages;
+        # pages still in use are discarded when they come back
+        if slot not in self._slots:
+            return
+        self._slots.remove(slot)
+        try:
+            await self._launch(self._idle)
+            self.note("relaunches")
+        except Exception as e:
+            print(f"[browser_pool] relaunch failed, supervisor will retry: {e}")
+        keep, drop = [], []
+        while not self._idle.empty():
+            page = self._idle.get_nowait()
+            (drop if self._owner.get(page) is slot else keep).append(page)
+        for page in keep:
+            self._idle.put_nowait(page)
+        for page in drop:
+            await self._discard(page)
+        if not slot.pages:
+            try:
+                await asyncio.wait_for(slot.browser.close(), timeout=10)
+            except Exception:
+                pass
+
+    async def _rss(self, slot: _Browser) -> int:
+        # Resident memory of all of the browser's processes; Linux /proc only
+        session = await slot.browser.new_browser_cdp_session()
+        try:
+            info = await session.send("SystemInfo.getProcessInfo")
+        finally:
+            await session.detach()
+        total = 0
+        for proc in info.get("processInfo", []):
+            try:
+                with open(f"/proc/{proc['id']}/statm") as f:
+                    total += int(f.read().split()[1]) * _PAGE_SIZE
+            except (OSError, ValueError, IndexError, KeyError):
+                pass
+        return total
+
+    async def _supervise(self) -> None:
+        while not self._closing:
+            await asyncio.sleep(self.check_interval)
+            for slot in list(self._slots):
+                if not slot.browser.is_connected():
+                    self._on_disconnected(slot)
+                    continue
+                if not self.max_rss:
+                    continue
+                try:
+                    slot.rss = await asyncio.wait_for(self._rss(slot), timeout=10)
+                except Exception:
+                    continue
+                if slot.rss > self.max_rss and slot in self._slots:
+                    self.note("recycled_rss")
+                    self._spawn(self._retire(slot))
+            while len(self._slots) < self.browsers and not self._closing:
+                try:
+                    await self._launch(self._idle)
+                    self.note("relaunches")
+                except Exception as e:
+                    print(f"[browser_pool] relaunch failed: {e}")
+                    break
+
+    def stats(self) -> dict:
+        return {
+            "browsers": len(self._slots),
+            "idle_pages": self._idle.qsize() if self._idle is not None else 0,
+            "renders": sum(slot.renders for slot in self._slots),
+            "rss_mb": [round(slot.rss / 1048576, 1) for slot in self._slots],
+            **self.counters,
+        }
+
+# Output formats: jpeg comes straight from Chromium; webp and png8 (palette
+# PNG) are re-encoded from the lossless screenshot with Pillow.
+IMAGE_TYPES = {"png": "image/png", "png8": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+EXTENSIONS = {"png": "png", "png8": "png", "webp": "webp", "jpeg": "jpg"}
 
-def md_to_html(md: str) -> str:
-    md = md.strip("\ufeff")  # trim BOM if pasted
-    parser = (
-        MarkdownIt("commonmark", {"html": False}) # disallow raw HTML
-        .use(front_matter_plugin)
-        .use(footnote_plugin)
-        .use(tasklists_plugin)
-        .use(deflist_plugin)
-    )
-    html_body = parser.render(md)
-    css = (ASSETS_DIR / "github-markdown.css").read_text(encoding="utf-8")
-    # Strict CSP: no external loads
-    csp = "default-src 'none'; img-src data:; style-src 'self' 'unsafe-inline'; font-src 'self' data:;"
-    template = f"""<!doctype html>
-<html>
-<head>
-<meta charset="utf-8"/>
-<meta http-equiv="Content-Security-Policy" content="{csp}"/>
-<meta name="viewport" content="width=device-width, initial-scale=1"/>
-<style>{css}</style>
-</head>
-<body>
-<article class="markdown-body">
-{html_body}
-</article>
-</body>
-</html>"""
-    return template
+def check_format(fmt: str) -> str:
+    if fmt not in IMAGE_TYPES:
+        raise ValueError(f"unknown format: {fmt}")
+    return fmt
+
+def encode_image(png: bytes, fmt: str, quality: int = 85) -> bytes:
+    from PIL import Image
+    img = Image.open(io.BytesIO(png))
+    out = io.BytesIO()
+    if fmt == "webp":
+        img.convert("RGB").save(out, format="WEBP", quality=quality, method=4)
+    elif fmt == "png8":
+        img.convert("RGB").quantize(colors=256).save(out, format="PNG", optimize=True)
+    else:
+        return png
+    return out.getvalue()
+
+def image_size(data: bytes) -> tuple[int, int]:
+    from PIL import Image
+    return Image.open(io.BytesIO(data)).size
+
+# Bottom edge (document coordinates) of every top-level block in the article;
+# tiles are cut on these so a paragraph or code block is not split in half.
+_BLOCK_BOTTOMS_JS = """() => Array.from(
+    document.querySelector('.markdown-body').children,
+    el => Math.ceil(el.getBoundingClientRect().bottom + window.scrollY)
+)"""
+
+# Replaces the article of a page holding a theme shell; data: images are
+# decoded before measuring, as set_content(wait_until="load") would.
+_SWAP_JS = """async html => {
+    const article = document.querySelector('article.markdown-body');
+    article.innerHTML = html;
+    window.scrollTo(0, 0);
+    await Promise.all(Array.from(article.querySelectorAll('img'), img => img.decode().catch(() => {})));
+    return document.documentElement.scrollHeight;
+}"""
+_RESET_JS = "() => document.querySelector('article.markdown-body').replaceChildren()"
+
+def plan_tiles(total: int, boundaries: list[int], tile_height: int) -> list[tuple[int, int]]:
+    # Greedy: each tile ends at the lowest block boundary that still leaves it
+    # at least half a tile tall, or at the hard limit when there is none.
+    bounds = sorted({b for b in boundaries if 0 < b < total})
+    tiles, top = [], 0
+    while top < total:
+        limit = top + tile_height
+        if limit >= total:
+            tiles.append((top, total))
+            break
+        cut = max((b for b in bounds if top + tile_height // 2 <= b <= limit), default=limit)
+        tiles.append((top, cut))
+        top = cut
+    return tiles
 
 class Renderer:
-    def __init__(self, width: int = 1024):
+    def __init__(
+        self,
+        width: int = 1024,
+        pool: Optional[BrowserPool] = None,
+        cache: Optional[RenderCache] = None,
+        pipeline: Optional[MarkdownPipeline] = None,
+        scheduler: Optional[RenderScheduler] = None,
+        workers=None,
+        fmt: str = "png",
+        quality: int = 85,
+        tile_height: int = 2048,
+        timeout: float = 20.0,
+        fast: Optional[FastRenderer] = None,
+        fast_concurrency: int = 0,
+        slow_renders: Optional[SlowRenderLog] = None,
+    ):
         self.width = width
+        self.fmt = check_format(fmt)
+        self.quality = quality
+        self.tile_height = tile_height
+        self.timeout = timeout  # per-render deadline in seconds (per tile when tiling); 0 disables
+        self.pool = pool or BrowserPool()
+        self.cache = cache
+        self.pipeline = pipeline or get_pipeline()
+        self.scheduler = scheduler or RenderScheduler(
+            concurrency=self.pool.browsers * self.pool.pages_per_browser
+        )
+        self.workers = workers  # optional WorkerPool: render in child processes instead
+        # page -> theme version of the shell it holds, see _load()
+        self._templates: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self.fast = fast  # optional browserless engine for simple Markdown
+        # Own threads for it so rasterizing never waits behind (or blocks)
+        # storage and cache I/O in the default executor; 0 = scheduler concurrency
+        fast_concurrency = fast_concurrency or self.scheduler.concurrency
+        self._fast_gate = asyncio.Semaphore(fast_concurrency)
+        self._fast_pool = ThreadPoolExecutor(fast_concurrency, thread_name_prefix="fast-render") if fast else None
+        self.fast_renders = 0
+        self.slow_renders = slow_renders
+        self._inflight: dict[str, tuple[asyncio.Future, Claim]] = {}
+        self.coalesced = 0
+        self.ready = False
+        self.warm_error: Optional[str] = None
 
-    async def html_to_png(self, html: str, *, width: Optional[int] = None) -> bytes:
-        width = width or self.width
-        # Playwright is imported lazily to keep import cost low
-        from playwright.async_api import async_playwright
-        async with async_playwright() as pw:
-            browser = await pw.chromium.launch()
-            page = await browser.new_page(viewport={"width": width, "height": 10})
+    def cache_key(self, md: str, width: int, theme: Optional[str] = None, fmt: str = "png", quality: int = 85) -> str:
+        h = hashlib.sha256()
+        fast = self.fast.version if self.fast is not None else ""
+        for part in (md, str(width), self.pipeline.version(theme), fast, fmt, str(quality)):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def render_key(
+        self,
+        md: str,
+        *,
+        width: Optional[int] = None,
+        theme: Optional[str] = None,
+        fmt: Optional[str] = None,
+        quality: Optional[int] = None,
+    ) -> str:
+        # cache_key with this renderer's defaults filled in
+        return self.cache_key(
+            md, width or self.width, theme, check_format(fmt or self.fmt),
+            min(100, max(1, quality or self.quality)),
+        )
+
+    async def warm_up(self) -> None:
+        # Launch the browsers (or every worker process) and do one throwaway
+        # render, so the first real request pays for neither
+        md = "# warm-up\n\n| a | b |\n|---|---|\n| `code` | *text* |\n"
+        if self.workers is not None:
+            await self.workers.warm_up(md, width=self.width, fmt=self.fmt, quality=self.quality)
+        else:
+            await self.render_local(md, fmt=self.fmt, quality=self.quality)
+        self.ready = True
+        self.warm_error = None
+
+    async def close(self) -> None:
+        if self.workers is not None:
+            await self.workers.close()
+        if self._fast_pool is not None:
+            self._fast_pool.shutdown(wait=False, cancel_futures=True)
+        await self.pool.close()
+
+    async def _within_deadline(self, coro):
+        # Cancelling the awaited coroutine unwinds BrowserPool.page(), which
+        # replaces the page (or the whole browser if the page will not close)
+        try:
+            return await asyncio.wait_for(coro, self.timeout or None)
+        except asyncio.TimeoutError:
+            self.pool.note("timeouts")
+            raise RenderTimeout(f"render timed out after {self.timeout:g}s") from None
+
+    async def html_to_image(
+        self,
+        html: str,
+        *,
+        width: Optional[int] = None,
+        fmt: str = "png",
+        quality: int = 85,
+        timer: Optional[StageTimer] = None,
+        theme: Optional[str] = None,
+    ) -> bytes:
+        # `html` is a full document, or with `theme` an article fragment from
+        # MarkdownPipeline.render_body swapped into that theme's warm page
+        timer = timer or StageTimer()
+        return await self._within_deadline(self._screenshot(html, theme, width or self.width, fmt, quality, timer))
+
+    async def _load(self, page, html: str, theme: Optional[str]) -> int:
+        # Returns the document height. The shell (and its stylesheet) is parsed
+        # once per page; later renders only replace the article's children.
+        if theme is None:
+            self._templates.pop(page, None)  # the full document replaces any shell
             await page.set_content(html, wait_until="load")
-            # Auto-size the page height
-            height = await page.evaluate("document.documentElement.scrollHeight")
+            return await page.evaluate("document.documentElement.scrollHeight")
+        version = self.pipeline.version(theme)
+        if self._templates.get(page) != version:
+            self._templates.pop(page, None)
+            await page.set_content(self.pipeline.shell(theme), wait_until="load")
+            self._templates[page] = version
+        return await page.evaluate(_SWAP_JS, html)
+
+    async def _reset(self, page, theme: Optional[str]) -> None:
+        # Drop the last document so an idle page does not keep its DOM alive
+        if theme is not None:
+            await page.evaluate(_RESET_JS)
+
+    async def _screenshot(self, html: str, theme: Optional[str], width: int, fmt: str, quality: int, timer: StageTimer) -> bytes:
+        async with self.pool.page() as page:
+            timer.lap("acquire")
+            # A short viewport so scrollHeight is the content height
+            await page.set_viewport_size({"width": width, "height": 10})
+            height = await self._load(page, html, theme)
+            timer.lap("set_content")
             await page.set_viewport_size({"width": width, "height": height})
-            buf = await page.screenshot(full_page=True, type="png")
-            await browser.close()
-            return buf
+            timer.lap("measure")
+            if fmt == "jpeg":
+                buf = await page.screenshot(full_page=True, type="jpeg", quality=quality)
+            else:
+                buf = await page.screenshot(full_page=True, type="png")
+            timer.lap("screenshot")
+            await self._reset(page, theme)
+        if fmt not in ("png", "jpeg"):
+            buf = await asyncio.to_thread(encode_image, buf, fmt, quality)
+            timer.lap("encode")
+        return buf
+
+    async def html_to_tiles(
+        self,
+        html: str,
+        *,
+        width: Optional[int] = None,
+        fmt: str = "png",
+        quality: int = 85,
+        tile_height: Optional[int] = None,
+        timer: Optional[StageTimer] = None,
+        theme: Optional[str] = None,
+    ) -> AsyncIterator[bytes]:
+        # `html` and `theme` as for html_to_image. The viewport stays one tile tall and each slice is captured after
+        # scrolling to it, so Chromium never rasterizes more than one tile.
+        width = width or self.width
+        tile_height = tile_height or self.tile_height
+        timer = timer or StageTimer()
+        async with self.pool.page() as page:
+            timer.lap("acquire")
+            total, boundaries = await self._within_deadline(
+                self._load_tiles(page, html, theme, width, tile_height, timer)
+            )
+            for top, bottom in plan_tiles(total, boundaries, tile_height):
+                buf = await self._within_deadline(self._tile(page, top, bottom, width, fmt, quality, timer))
+                yield buf
+                timer.lap("consumer")  # time the caller spent on the previous tile
+            await self._reset(page, theme)
+
+    async def _load_tiles(self, page, html: str, theme: Optional[str], width: int, tile_height: int, timer: StageTimer):
+        # Measure with a short viewport as _screenshot does, so a page shorter
+        # than one tile is not padded out to tile_height
+        await page.set_viewport_size({"width": width, "height": 10})
+        total = await self._load(page, html, theme)
+        timer.lap("set_content")
+        await page.set_viewport_size({"width": width, "height": min(total, tile_height)})
+        boundaries = await page.evaluate(_BLOCK_BOTTOMS_JS)
+        timer.lap("measure")
+        return total, boundaries
+
+    async def _tile(self, page, top: int, bottom: int, width: int, fmt: str, quality: int, timer: StageTimer) -> bytes:
+        # The last tile may not scroll fully to `top`; clip relative to where it landed
+        y = await page.evaluate("y => { window.scrollTo(0, y); return window.scrollY; }", top)
+        clip = {"x": 0, "y": top - y, "width": width, "height": bottom - top}
+        if fmt == "jpeg":
+            buf = await page.screenshot(clip=clip, type="jpeg", quality=quality)
+        else:
+            buf = await page.screenshot(clip=clip, type="png")
+        timer.lap("screenshot")
+        if fmt not in ("png", "jpeg"):
+            buf = await asyncio.to_thread(encode_image, buf, fmt, quality)
+            timer.lap("encode")
+        return buf
+
+    async def html_to_png(self, html: str, *, width: Optional[int] = None) -> bytes:
+        return await self.html_to_image(html, width=width)
+
+    async def render_markdown(
+        self,
+        md: str,
+        *,
+        width: Optional[int] = None,
+        theme: Optional[str] = None,
+        fmt: Optional[str] = None,
+        quality: Optional[int] = None,
+        owner: Hashable = None,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> bytes:
+        # Cache hits skip the queue. Identical requests already in flight are
+        # coalesced onto one job (single-flight); otherwise the job waits for
+        # a scheduler slot (may raise SchedulerBusy) before touching the browser.
+        width = width or self.width
+        fmt = check_format(fmt or self.fmt)
+        quality = min(100, max(1, quality or self.quality))
+        key = self.cache_key(md, width, theme, fmt, quality)  # unknown themes fail here with ValueError
+        if key not in self._inflight and self.cache:
+            data = await self.cache.get(key)
+            if data is not None:
+                return data
+        start = lambda claim: self._render_uncached(key, md, width, theme, fmt, quality, claim)
+        return await self._join(key, owner, priority, start)
+
+    async def _join(self, key: str, owner: Hashable, priority: Priority, start):
+        # Single-flight: callers of an identical render share one job, which
+        # is queued at the most urgent priority among them. A job rejected on
+        # its first caller's per-owner limit is retried once for the others.
+        entry = self._inflight.get(key)
+        if entry is None:
+            claim = Claim(owner, priority)
+            job = asyncio.ensure_future(start(claim))
+            self._inflight[key] = (job, claim)
+            job.add_done_callback(lambda j: self._job_done(key, j))
+        else:
+            job, claim = entry
+            self.coalesced += 1
+            self.scheduler.promote(claim, priority)
+        try:
+            # Shielded so one caller giving up does not cancel the others' render
+            return await asyncio.shield(job)
+        except SchedulerBusy:
+            if claim.owner == owner:
+                raise
+        return await start(Claim(owner, priority))
+
+    def _job_done(self, key: str, job: asyncio.Future) -> None:
+        entry = self._inflight.get(key)
+        if entry is not None and entry[0] is job:
+            del self._inflight[key]
+        if not job.cancelled():
+            job.exception()  # mark retrieved even if every waiter went away
+
+    def _note_slow(self, md, started, timer, engine, width, theme, fmt, *, data=None, height=None, tiles=None, error=None) -> None:
+        # Failed renders are kept too: a timeout is the slowest render of all
+        seconds = time.perf_counter() - started
+        if self.slow_renders is None or not self.slow_renders.is_slow(seconds):
+            return
+        if data is not None:
+            height = image_size(data)[1]
+        self.slow_renders.record(
+            md, seconds, timer.stages, engine=engine, width=width, theme=theme, fmt=fmt,
+            height=height, tiles=tiles, error=error,
+        )
+
+    async def _render_uncached(self, key, md, width, theme, fmt, quality, claim: Claim) -> bytes:
+        # With RENDER_WORKERS the fast path runs in the worker, inside the same
+        # job as the browser fallback; otherwise here, before taking a slot.
+        started = time.perf_counter()
+        timer = StageTimer()
+        data = parsed = None
+        engine = "fast"
+        try:
+            if self.fast is not None and self.workers is None:
+                parsed, data = await self.try_fast(md, width=width, theme=theme, fmt=fmt, quality=quality, timer=timer)
+            if data is None:
+                engine = "worker" if self.workers is not None else "browser"
+                async with self.scheduler.slot(claim.owner, claim.priority, claim):
+                    timer.lap("queue")
+                    if self.workers is not None:
+                        data = await self.workers.render(
+                            md, width=width, theme=theme, fmt=fmt, quality=quality, fast=self.fast is not None, timer=timer,
+                        )
+                    else:
+                        data = await self.render_local(
+                            md, width=width, theme=theme, fmt=fmt, quality=quality, timer=timer, parsed=parsed,
+                        )
+        except Exception as e:
+            self._note_slow(md, started, timer, engine, width, theme, fmt, error=str(e) or type(e).__name__)
+            raise
+        if "rasterize" in timer.stages:
+            engine = "fast"
+            self.fast_renders += 1
+        metrics.observe_stages(timer.stages)
+        self._note_slow(md, started, timer, engine, width, theme, fmt, data=data)
+        if self.cache:
+            await self.cache.put(key, data)
+        return data
+
+    async def try_fast(
+        self,
+        md: str,
+        *,
+        width: int,
+        theme: Optional[str],
+        fmt: str,
+        quality: int,
+        timer: StageTimer,
+        max_height: int = 0,
+    ) -> tuple[tuple, Optional[bytes]]:
+        # The Pillow engine on its own small thread pool (at most
+        # `fast_concurrency` at once) and under the render deadline. Returns
+        # the parsed document, reused by the browser fallback, and the image
+        # or None when the browser is needed.
+        async with self._fast_gate:
+            job = asyncio.get_running_loop().run_in_executor(
+                self._fast_pool, self._render_fast, md, width, theme, fmt, quality, timer, max_height,
+            )
+            try:
+                return await asyncio.wait_for(job, self.timeout or None)
+            except asyncio.TimeoutError:
+                raise RenderTimeout(f"render timed out after {self.timeout:g}s") from None
+
+    def _render_fast(self, md, width, theme, fmt, quality, timer: StageTimer, max_height: int = 0):
+        # No image when the document needs the browser (unsupported tokens or
+        # glyphs) or is taller than `max_height`; "rasterize" is only lapped
+        # for an image, layout work on a declined document counts as "parse"
+        parsed = self.pipeline.parse(md)
+        theme = theme or self.pipeline.default_theme
+        data = None
+        if self.fast.supports(parsed[0], theme):
+            data = self.fast.render(parsed[0], width=width, theme=theme, fmt=fmt, quality=quality, max_height=max_height)
+        if data is None:
+            timer.lap("parse")
+            return parsed, None
+        timer.lap("rasterize")
+        return parsed, data
+
+    async def render_pages(
+        self,
+        md: str,
+        *,
+        width: Optional[int] = None,
+        theme: Optional[str] = None,
+        fmt: Optional[str] = None,
+        quality: Optional[int] = None,
+        tile_height: Optional[int] = None,
+        owner: Hashable = None,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> list[bytes]:
+        # For chat replies: one image when the rendered page is at most
+        # `tile_height` px tall, otherwise its tiles. Decided on the measured
+        # height, so short results still come from (and go to) the cache and
+        # the fast path. The slot is released before this returns, so the
+        # caller can upload without holding a browser page.
+        width = width or self.width
+        fmt = check_format(fmt or self.fmt)
+        quality = min(100, max(1, quality or self.quality))
+        tile_height = max(256, tile_height or self.tile_height)
+        key = self.cache_key(md, width, theme, fmt, quality)
+        if self.cache:
+            data = await self.cache.get(key)
+            if data is not None and image_size(data)[1] <= tile_height:
+                return [data]
+        start = lambda claim: self._render_pages_uncached(key, md, width, theme, fmt, quality, tile_height, claim)
+        return await self._join(f"{key}:pages:{tile_height}", owner, priority, start)
+
+    async def _render_pages_uncached(self, key, md, width, theme, fmt, quality, tile_height, claim: Claim) -> list[bytes]:
+        started = time.perf_counter()
+        timer = StageTimer()
+        parsed = None
+        if self.fast is not None and self.workers is None:
+            parsed, data = await self.try_fast(
+                md, width=width, theme=theme, fmt=fmt, quality=quality, timer=timer, max_height=tile_height,
+            )
+            if data is not None:
+                self.fast_renders += 1
+                metrics.observe_stages(timer.stages)
+                self._note_slow(md, started, timer, "fast", width, theme, fmt, data=data)
+                if self.cache:
+                    await self.cache.put(key, data)
+                return [data]
+        tiles = self._tiles(
+            md, width, theme, fmt, quality, tile_height, claim,
+            fast=self.fast is not None, parsed=parsed, started=started, timer=timer,
+        )
+        async with aclosing(tiles):
+            pages = [tile async for tile in tiles]
+        if len(pages) == 1 and self.cache:
+            # A single tile is the whole page, the same image render_markdown returns
+            await self.cache.put(key, pages[0])
+        return pages
+
+    async def render_tiles(
+        self,
+        md: str,
+        *,
+        width: Optional[int] = None,
+        theme: Optional[str] = None,
+        fmt: Optional[str] = None,
+        quality: Optional[int] = None,
+        tile_height: Optional[int] = None,
+        owner: Hashable = None,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> AsyncIterator[bytes]:
+        # Tiled variant of render_markdown for long documents: yields the
+        # image in slices of at most `tile_height` px. Not cached; holds one
+        # scheduler slot (and browser page) until the iterator is exhausted
+        # or closed, so consume it promptly and close it with aclosing().
+        width = width or self.width
+        fmt = check_format(fmt or self.fmt)
+        quality = min(100, max(1, quality or self.quality))
+        tile_height = max(256, tile_height or self.tile_height)
+        self.pipeline.version(theme)
+        tiles = self._tiles(md, width, theme, fmt, quality, tile_height, Claim(owner, priority))
+        async with aclosing(tiles):
+            async for tile in tiles:
+                yield tile
+
+    async def _tiles(
+        self, md, width, theme, fmt, quality, tile_height, claim: Claim, *,
+        fast: bool = False, parsed=None, started: Optional[float] = None, timer: Optional[StageTimer] = None,
+    ) -> AsyncIterator[bytes]:
+        # `fast` lets a worker answer with one fast-path image when the page
+        # fits a tile; `parsed` is a document try_fast already parsed here
+        started = started or time.perf_counter()
+        timer = timer or StageTimer()
+        height = count = 0
+        engine = "worker" if self.workers is not None else "browser"
+        try:
+            async with self.scheduler.slot(claim.owner, claim.priority, claim):
+                timer.lap("queue")
+                if self.workers is not None:
+                    tiles = self.workers.render_tiles(
+                        md, width=width, theme=theme, fmt=fmt, quality=quality, tile_height=tile_height,
+                        fast=fast, timer=timer,
+                    )
+                else:
+                    tiles = self.render_tiles_local(
+                        md, width=width, theme=theme, fmt=fmt, quality=quality, tile_height=tile_height,
+                        timer=timer, parsed=parsed,
+                    )
+                async with aclosing(tiles):
+                    async for tile in tiles:
+                        count += 1
+                        if self.slow_renders is not None:
+                            height += image_size(tile)[1]
+                        yield tile
+        except Exception as e:
+            self._note_slow(
+                md, started, timer, engine, width, theme, fmt, height=height or None, tiles=count,
+                error=str(e) or type(e).__name__,
+            )
+            raise
+        if "rasterize" in timer.stages:
+            engine = "fast"
+            self.fast_renders += 1
+        metrics.observe_stages(timer.stages)
+        self._note_slow(md, started, timer, engine, width, theme, fmt, height=height or None, tiles=count)
+
+    async def render_tiles_local(
+        self,
+        md: str,
+        *,
+        width: Optional[int] = None,
+        theme: Optional[str] = None,
+        fmt: str = "png",
+        quality: int = 85,
+        tile_height: Optional[int] = None,
+        timer: Optional[StageTimer] = None,
+        parsed: Optional[tuple] = None,
+    ) -> AsyncIterator[bytes]:
+        timer = timer or StageTimer()
+        theme = self.pipeline._theme(theme)
+        body = self.pipeline.render_tokens(parsed or self.pipeline.parse(md))
+        timer.lap("parse")
+        tiles = self.html_to_tiles(
+            body, theme=theme, width=width, fmt=fmt, quality=quality, tile_height=tile_height, timer=timer,
+        )
+        async with aclosing(tiles):
+            async for tile in tiles:
+                yield tile
 
-    async def render_markdown(self, md: str, *, width: Optional[int] = None) -> bytes:
-        html = md_to_html(md)
-        return await self.html_to_png(html, width=width)
+    async def render_local(
+        self,
+        md: str,
+        *,
+        width: Optional[int] = None,
+        theme: Optional[str] = None,
+        fmt: str = "png",
+        quality: int = 85,
+        timer: Optional[StageTimer] = None,
+        parsed: Optional[tuple] = None,
+    ) -> bytes:
+        # Parse (unless try_fast already did) and screenshot in this process,
+        # bypassing cache and scheduler
+        timer = timer or StageTimer()
+        theme = self.pipeline._theme(theme)
+        body = self.pipeline.render_tokens(parsed or self.pipeline.parse(md))
+        timer.lap("parse")
+        return await self.html_to_image(body, theme=theme, width=width, fmt=fmt, quality=quality, timer=timer)
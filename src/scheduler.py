@@ -0,0 +1,154 @@
+from __future__ import annotations
+import asyncio, math, time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Hashable, Optional
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # DMs and /render
+    CHANNEL = 1      # channel/group autoconvert
+    BULK = 2         # HTTP API
+
+class SchedulerBusy(Exception):
+    def __init__(self, reason: str, retry_after: int = 1):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+class Claim:
+    # One caller's place in line. Single-flight renders keep it so a more
+    # urgent caller joining the job can raise its priority while it waits.
+    __slots__ = ("owner", "priority", "fut")
+
+    def __init__(self, owner: Hashable, priority: Priority = Priority.INTERACTIVE):
+        self.owner = owner
+        self.priority = priority
+        self.fut: Optional[asyncio.Future] = None  # set while queued
+
+# Fair gate in front of the browser: at most `concurrency` renders run at once.
+# Waiters are grouped by priority class, and inside a class by owner (user,
+# chat or API key) with owners served round-robin, so one caller's burst
+# cannot starve everyone else. Queues are bounded globally and per owner;
+# beyond that callers get SchedulerBusy instead of waiting.
+class RenderScheduler:
+    def __init__(self, concurrency: int = 2, max_queue: int = 100, per_owner_queue: int = 5):
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max_queue
+        self.per_owner_queue = per_owner_queue
+        self._active = 0
+        self._queued = 0
+        self._queued_by_owner: dict[Hashable, int] = {}
+        self._queues: list[OrderedDict[Hashable, deque]] = [OrderedDict() for _ in Priority]
+        self._avg_hold = 1.0  # EWMA of seconds a slot is held, for Retry-After hints
+        self.rejected = 0
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self._avg_hold * (self._queued / self.concurrency + 1)))
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        raise SchedulerBusy(reason, retry_after=self._retry_after())
+
+    async def _acquire(self, claim: Claim) -> None:
+        owner = claim.owner
+        if self._active < self.concurrency and self._queued == 0:
+            self._active += 1
+            return
+        if self._queued >= self.max_queue:
+            self._reject("render queue is full")
+        if self._queued_by_owner.get(owner, 0) >= self.per_owner_queue:
+            self._reject("too many pending renders")
+        fut = claim.fut = asyncio.get_running_loop().create_future()
+        self._queues[claim.priority].setdefault(owner, deque()).append(fut)
+        self._queued += 1
+        self._queued_by_owner[owner] = self._queued_by_owner.get(owner, 0) + 1
+        try:
+            await fut  # the slot is handed over already counted in _active
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release()
+            else:
+                self._forget(owner, claim.priority, fut)
+            raise
+        finally:
+            claim.fut = None
+
+    def promote(self, claim: Claim, priority: Priority) -> None:
+        # Move a claim to a more urgent class; once it holds a slot this only
+        # records the new priority
+        if priority >= claim.priority:
+            return
+        fut = claim.fut
+        if fut is not None and not fut.done():
+            queues = self._queues[claim.priority]
+            dq = queues.get(claim.owner)
+            if dq is not None and fut in dq:
+                dq.remove(fut)
+                if not dq:
+                    del queues[claim.owner]
+                self._queues[priority].setdefault(claim.owner, deque()).append(fut)
+        claim.priority = priority
+
+    def _dequeued(self, owner: Hashable) -> None:
+        self._queued -= 1
+        left = self._queued_by_owner.pop(owner) - 1
+        if left:
+            self._queued_by_owner[owner] = left
+
+    def _forget(self, owner: Hashable, priority: Priority, fut: asyncio.Future) -> None:
+        queues = self._queues[priority]
+        dq = queues.get(owner)
+        if dq is None or fut not in dq:
+            return
+        dq.remove(fut)
+        if not dq:
+            del queues[owner]
+        self._dequeued(owner)
+
+    def _next_waiter(self):
+        for queues in self._queues:
+            while queues:
+                owner, dq = queues.popitem(last=False)
+                fut = dq.popleft()
+                if dq:
+                    queues[owner] = dq  # back of the line: round-robin across owners
+                self._dequeued(owner)
+                if not fut.done():
+                    return fut
+        return None
+
+    def _release(self) -> None:
+        self._active -= 1
+        while self._active < self.concurrency:
+            fut = self._next_waiter()
+            if fut is None:
+                break
+            self._active += 1
+            fut.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, owner: Hashable, priority: Priority = Priority.INTERACTIVE, claim: Optional[Claim] = None):
+        await self._acquire(claim or Claim(owner, priority))
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._avg_hold = 0.8 * self._avg_hold + 0.2 * (time.monotonic() - started)
+            self._release()
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "concurrency": self.concurrency,
+            "queued": self._queued,
+            "queued_by_priority": {p.name.lower(): sum(len(dq) for dq in self._queues[p].values()) for p in Priority},
+            "rejected": self.rejected,
+        }
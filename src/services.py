@@ -0,0 +1,137 @@
+from __future__ import annotations
+import asyncio, hashlib, time
+# Process-wide shared instances: the bot, its plugins and the API all use these
+# so there is exactly one browser pool and one state store per process.
+from .config import cfg
+from .storage import Storage
+from .renderer import ASSETS_DIR, BrowserPool, MarkdownPipeline, Renderer
+from .fastpath import FastRenderer
+from .profiling import SlowRenderLog
+from .cache import FileIdCache, RenderCache
+from .scheduler import RenderScheduler
+from .ratelimit import RateLimiter
+from .workers import WorkerPool
+from .jobs import JobStore
+from . import metrics
+
+storage = Storage(
+    path=cfg.storage_path or None,
+    backend=cfg.storage_backend,
+    flush_interval=cfg.stats_flush_interval,
+    hourly_retention_days=cfg.stats_hourly_days,
+)
+
+def _browser_event(kind: str, n: int = 1) -> None:
+    # Supervisor interventions (timeouts, crashes, recycles) land in the persistent stats
+    storage.inc_stat(f"browser_{kind}", n)
+
+pool = BrowserPool(
+    browsers=cfg.browser_pool_size,
+    pages_per_browser=cfg.pages_per_browser,
+    recycle_after=cfg.browser_recycle_renders,
+    max_rss_mb=cfg.browser_max_rss_mb,
+    check_interval=cfg.browser_check_interval,
+    on_event=_browser_event,
+)
+# With RENDER_WORKERS > 0 each worker process owns a pool of this size and the
+# in-process pool stays unused.
+workers = WorkerPool(
+    count=cfg.render_workers,
+    job_timeout=cfg.render_timeout * 4,
+    on_event=_browser_event,
+) if cfg.render_workers > 0 else None
+fast = FastRenderer.from_assets(
+    ASSETS_DIR, extra_fonts=tuple(p.strip() for p in cfg.fast_render_fonts.split(",") if p.strip()),
+) if cfg.fast_render else None
+if fast is not None and not fast.available:
+    print("[fast_render] no usable fonts found, every render uses the browser")
+    fast = None
+capacity = pool.browsers * pool.pages_per_browser * (workers.count if workers else 1)
+renderer = Renderer(
+    width=cfg.render_width,
+    fmt=cfg.render_format,
+    quality=cfg.render_quality,
+    tile_height=cfg.tile_height,
+    timeout=cfg.render_timeout,
+    pipeline=MarkdownPipeline.from_assets(default_theme=cfg.render_theme),
+    pool=pool,
+    workers=workers,
+    fast=fast,
+    slow_renders=SlowRenderLog(
+        threshold_ms=cfg.slow_render_ms,
+        capacity=cfg.slow_render_keep,
+        capture_input=cfg.slow_render_capture,
+    ),
+    scheduler=RenderScheduler(
+        concurrency=cfg.render_concurrency or capacity,
+        max_queue=cfg.render_queue_max,
+        per_owner_queue=cfg.render_queue_per_user,
+    ),
+    cache=RenderCache(
+        max_items=cfg.render_cache_items,
+        max_bytes=cfg.render_cache_mb * 1024 * 1024,
+        disk_dir="storage/render_cache",
+        disk_max_bytes=cfg.render_cache_disk_mb * 1024 * 1024,
+    ),
+)
+limiter = RateLimiter(
+    user=cfg.rate_limit_user,
+    chat=cfg.rate_limit_chat,
+    api=cfg.rate_limit_api,
+)
+metrics.watch(renderer, limiter)
+file_ids = FileIdCache(max_items=cfg.file_id_cache_items, path="storage/file_ids.json")
+jobs = JobStore(
+    ttl=cfg.jobs_ttl,
+    max_jobs=cfg.jobs_max,
+    memory_bytes=cfg.jobs_memory_mb * 1024 * 1024,
+    disk_dir="storage/jobs",
+    disk_bytes=cfg.jobs_disk_mb * 1024 * 1024,
+    per_owner=renderer.scheduler.per_owner_queue,
+)
+
+# The bot's telegram Application while it runs in webhook mode; the API's
+# webhook route feeds updates into its update_queue.
+bot_app = None
+
+def webhook_secret() -> str:
+    # Same on every replica without extra configuration; Telegram allows [A-Za-z0-9_-]
+    return cfg.webhook_secret or hashlib.sha256(f"md2img-webhook:{cfg.bot_token}".encode()).hexdigest()
+
+_warmup: asyncio.Task | None = None
+
+def start_warmup() -> None:
+    # Idempotent; /readyz reports ready once the renderer has warmed up
+    global _warmup
+    if _warmup is None and cfg.prewarm:
+        _warmup = asyncio.create_task(_warm())
+
+async def _warm():
+    delay = 1.0
+    while True:
+        started = time.monotonic()
+        try:
+            await renderer.warm_up()
+        except Exception as e:
+            renderer.warm_error = str(e) or type(e).__name__
+            print(f"[warmup] failed, retrying in {delay:.0f}s: {renderer.warm_error}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+            continue
+        print(f"[warmup] renderer ready in {time.monotonic() - started:.1f}s")
+        return
+
+_shut_down = False
+
+async def shutdown():
+    # Idempotent; flagged before the first await so concurrent callers also return
+    global _shut_down
+    if _shut_down:
+        return
+    _shut_down = True
+    if _warmup is not None:
+        _warmup.cancel()
+    await jobs.close()
+    await renderer.close()
+    await asyncio.to_thread(file_ids.save)
+    await asyncio.to_thread(storage.close)
@@ -1,5 +1,6 @@
 from __future__ import annotations
-import json, os, time, threading
+import copy, heapq, json, os, sqlite3, time, threading
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Any
 
@@ -19,17 +20,96 @@ DEFAULT_STATE = {
     }
 }
 
-class Storage:
+HOUR, DAY = 3600, 86400
+PERIODS = {"hour": HOUR, "day": DAY}
+USER_KEYS = ("requests", "render_success")
+
+# Deltas: global counters, per-user counters and global counters per UTC hour
+# (hour start as a string key, so journal lines stay plain JSON). Daily
+# buckets are derived from the hourly ones when deltas are applied.
+def _new_deltas() -> dict:
+    return {"stats": {}, "per_user": {}, "hourly": {}}
+
+def _add(dst: dict, src: dict, sign: int = 1) -> None:
+    # Counters that reach 0 are dropped, so subtracting a flushed snapshot
+    # leaves nothing behind for keys that saw no new increments
+    for key, n in src.items():
+        value = dst.get(key, 0) + sign * n
+        if value:
+            dst[key] = value
+        else:
+            dst.pop(key, None)
+
+def _merge_deltas(dst: dict, src: dict, sign: int = 1) -> None:
+    _add(dst["stats"], src["stats"], sign)
+    for section in ("per_user", "hourly"):
+        for key, counters in src.get(section, {}).items():  # no "hourly" in older journals
+            merged = dst[section].setdefault(key, {})
+            _add(merged, counters, sign)
+            if not merged:
+                del dst[section][key]
+
+def _is_empty(deltas: dict) -> bool:
+    return not deltas["stats"] and not deltas["per_user"] and not deltas["hourly"]
+
+def _bucket_deltas(deltas: dict) -> dict[str, dict[int, dict]]:
+    out: dict[str, dict[int, dict]] = {"hour": {}, "day": {}}
+    for hour, counters in deltas.get("hourly", {}).items():
+        start = int(hour)
+        _add(out["hour"].setdefault(start, {}), counters)
+        _add(out["day"].setdefault(start - start % DAY, {}), counters)
+    return out
+
+def _apply_deltas(data: dict, deltas: dict, hourly_before: int = 0) -> None:
+    stats = data["stats"]
+    for key, n in deltas["stats"].items():
+        stats[key] = stats.get(key, 0) + n
+    per = stats["per_user"]
+    for uid, counters in deltas["per_user"].items():
+        user = per.get(uid, {"requests":0, "render_success":0})
+        for key, n in counters.items():
+            user[key] = user.get(key, 0) + n
+        per[uid] = user
+    buckets = data.setdefault("buckets", {"hour": {}, "day": {}})
+    for period, rows in _bucket_deltas(deltas).items():
+        for start, counters in rows.items():
+            _add(buckets[period].setdefault(str(start), {}), counters)
+    if hourly_before:
+        for start in [s for s in buckets["hour"] if int(s) < hourly_before]:
+            del buckets["hour"][start]
+
+def _top(rows, key: str, n: int) -> list[tuple[str, dict]]:
+    # Highest `key` first; ties by higher user id, the order SQLite's index gives
+    return heapq.nlargest(n, ((uid, c) for uid, c in rows if c.get(key, 0) > 0), key=lambda r: (r[1].get(key, 0), int(r[0])))
+
+# Immutable view of the permission-related config, rebuilt whenever the config
+# changes so authorization checks are pure set lookups.
+@dataclass(frozen=True)
+class AuthSnapshot:
+    public_enabled: bool
+    whitelist: frozenset[int]
+    blacklist: frozenset[int]
+
+    @classmethod
+    def from_config(cls, conf: dict) -> "AuthSnapshot":
+        return cls(
+            public_enabled=bool(conf.get("public_enabled", True)),
+            whitelist=frozenset(int(u) for u in conf.get("whitelist", [])),
+            blacklist=frozenset(int(u) for u in conf.get("blacklist", [])),
+        )
+
+class JSONBackend:
+    # Whole state in one JSON document; fine for small installs.
     def __init__(self, path: str | None = None):
         self.path = Path(path or "storage/state.json")
-        self._lock = threading.RLock()
         self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._cache: tuple[int, dict] | None = None
         if not self.path.exists():
             self._write(DEFAULT_STATE)
 
     def _read(self) -> dict:
         if not self.path.exists():
-            return DEFAULT_STATE.copy()
+            return copy.deepcopy(DEFAULT_STATE)
         with self.path.open("r", encoding="utf-8") as f:
             return json.load(f)
 
@@ -39,46 +119,568 @@ class Storage:
             json.dump(data, f, ensure_ascii=False, indent=2)
         tmp.replace(self.path)
 
+    def load(self) -> dict:
+        return self._read()
+
+    def load_config(self) -> dict:
+        return self._read()["config"]
+
+    def save_config(self, conf: dict) -> None:
+        data = self._read()
+        data["config"] = conf
+        self._write(data)
+
+    def apply_deltas(self, deltas: dict, hourly_before: int = 0, generation: int | None = None) -> None:
+        data = self._read()
+        _apply_deltas(data, deltas, hourly_before)
+        if generation is not None:
+            data["journal_generation"] = generation
+        self._write(data)
+
+    def journal_generation(self) -> int:
+        return self._read().get("journal_generation", 0)
+
+    # Read-only queries share one parsed copy until the file changes. This
+    # backend keeps no indexes, so user queries scan per_user; use sqlite
+    # once that gets large.
+    def _cached(self) -> dict:
+        mtime = self.mtime()
+        if self._cache is None or self._cache[0] != mtime:
+            self._cache = (mtime, self._read())
+        return self._cache[1]
+
+    def totals(self) -> dict:
+        stats = self._cached()["stats"]
+        return {k: v for k, v in stats.items() if k != "per_user"}
+
+    def user_count(self) -> int:
+        return len(self._cached()["stats"]["per_user"])
+
+    def user(self, uid: str) -> dict | None:
+        counters = self._cached()["stats"]["per_user"].get(uid)
+        return dict(counters) if counters is not None else None
+
+    def users(self, uids: list[str]) -> dict[str, dict]:
+        per_user = self._cached()["stats"]["per_user"]
+        return {uid: dict(per_user[uid]) for uid in uids if uid in per_user}
+
+    def top_users(self, key: str, n: int) -> list[tuple[str, dict]]:
+        return [(uid, dict(c)) for uid, c in _top(self._cached()["stats"]["per_user"].items(), key, n)]
+
+    def buckets(self, period: str, since: int, until: int) -> dict[int, dict]:
+        rows = self._cached().get("buckets", {}).get(period, {})
+        return {int(s): dict(c) for s, c in rows.items() if since <= int(s) <= until}
+
+    def mtime(self) -> int:
+        try:
+            return self.path.stat().st_mtime_ns
+        except OSError:
+            return 0
+
+    def close(self) -> None:
+        pass
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS user_counters (
+    user_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS user_counters_by_value ON user_counters (key, value);
+CREATE TABLE IF NOT EXISTS stat_buckets (
+    period TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, start, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_lists (
+    list_name TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (list_name, user_id)
+) WITHOUT ROWID;
+"""
+
+# Indexed tables in a WAL-mode SQLite database. Counter updates are upserts
+# that touch only the affected rows, so cost no longer grows with user count.
+# The number of users is kept in meta and top-N reads walk the (key, value)
+# index. Calls are serialised by Storage, hence one shared connection.
+class SQLiteBackend:
+    def __init__(self, path: str | None = None, migrate_from: str | None = None):
+        self.path = Path(path or "storage/state.db")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        migrate_from = migrate_from or str(self.path.with_suffix(".json"))
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._closed = False
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        if self._meta("created_at") is None:
+            legacy = Path(migrate_from)
+            if legacy.exists():
+                self._import_json(legacy)
+            else:
+                self._import(copy.deepcopy(DEFAULT_STATE))
+        if self._meta("user_count") is None:  # databases from before the count was kept
+            (n,) = self._db.execute("SELECT COUNT(DISTINCT user_id) FROM user_counters").fetchone()
+            self._set_meta("user_count", n)
+
+    def _meta(self, key: str):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_meta(self, key: str, value) -> None:
+        self._db.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value, ensure_ascii=False)),
+        )
+
+    def _import_json(self, legacy: Path) -> None:
+        with legacy.open("r", encoding="utf-8") as f:
+            data = json.load(f)
+        self._import(data)
+        legacy.replace(legacy.with_name(legacy.name + ".migrated"))
+        print(f"[storage] migrated {legacy} -> {self.path}")
+
+    def _import(self, data: dict) -> None:
+        stats = data.get("stats", {})
+        deltas = {
+            "stats": {k: v for k, v in stats.items() if k != "per_user"},
+            "per_user": stats.get("per_user", {}),
+        }
+        deltas["hourly"] = {}
+        with self._db:
+            self._db.execute("BEGIN")
+            self._set_meta("created_at", data.get("created_at", int(time.time())))
+            self._set_meta("user_count", 0)
+            self._save_config(data.get("config", DEFAULT_STATE["config"]))
+            self._apply(deltas)
+            for period, rows in data.get("buckets", {}).items():
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO stat_buckets (period, start, key, value) VALUES (?, ?, ?, ?)",
+                    [(period, int(start), key, n) for start, counters in rows.items() for key, n in counters.items()],
+                )
+
+    def load(self) -> dict:
+        per_user: dict[str, dict] = {}
+        for uid, key, value in self._db.execute("SELECT user_id, key, value FROM user_counters"):
+            per_user.setdefault(str(uid), {"requests":0, "render_success":0})[key] = value
+        stats = {"total_requests": 0, "render_success": 0, "render_failed": 0}
+        stats.update(self._db.execute("SELECT key, value FROM counters"))
+        stats["per_user"] = per_user
+        return {"created_at": self._meta("created_at"), "stats": stats, "config": self.load_config()}
+
+    def load_config(self) -> dict:
+        conf = {
+            "public_enabled": self._meta("public_enabled"),
+            "whitelist": [],
+            "blacklist": [],
+            "enabled_plugins": self._meta("enabled_plugins") or [],
+        }
+        if conf["public_enabled"] is None:
+            conf["public_enabled"] = True
+        rows = self._db.execute("SELECT list_name, user_id FROM user_lists ORDER BY list_name, user_id")
+        for name, uid in rows:
+            conf.setdefault(name, []).append(uid)
+        return conf
+
+    def _save_config(self, conf: dict) -> None:
+        for key, value in conf.items():
+            if key in ("whitelist", "blacklist"):
+                self._db.execute("DELETE FROM user_lists WHERE list_name = ?", (key,))
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO user_lists (list_name, user_id) VALUES (?, ?)",
+                    [(key, int(uid)) for uid in value],
+                )
+            else:
+                self._set_meta(key, value)
+
+    def save_config(self, conf: dict) -> None:
+        with self._db:
+            self._db.execute("BEGIN")
+            self._save_config(conf)
+
+    def _apply(self, deltas: dict, hourly_before: int = 0) -> None:
+        new_users = sum(
+            1 for uid in deltas["per_user"]
+            if self._db.execute("SELECT 1 FROM user_counters WHERE user_id = ? LIMIT 1", (int(uid),)).fetchone() is None
+        )
+        if new_users:
+            self._set_meta("user_count", (self._meta("user_count") or 0) + new_users)
+        self._db.executemany(
+            "INSERT INTO counters (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+            deltas["stats"].items(),
+        )
+        self._db.executemany(
+            "INSERT INTO user_counters (user_id, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id, key) DO UPDATE SET value = value + excluded.value",
+            [(int(uid), key, n) for uid, counters in deltas["per_user"].items() for key, n in counters.items()],
+        )
+        self._db.executemany(
+            "INSERT INTO stat_buckets (period, start, key, value) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(period, start, key) DO UPDATE SET value = value + excluded.value",
+            [
+                (period, start, key, n)
+                for period, rows in _bucket_deltas(deltas).items()
+                for start, counters in rows.items() for key, n in counters.items()
+            ],
+        )
+        if hourly_before:
+            self._db.execute("DELETE FROM stat_buckets WHERE period = 'hour' AND start < ?", (hourly_before,))
+
+    def apply_deltas(self, deltas: dict, hourly_before: int = 0, generation: int | None = None) -> None:
+        with self._db:
+            self._db.execute("BEGIN")
+            self._apply(deltas, hourly_before)
+            if generation is not None:
+                self._set_meta("journal_generation", generation)
+
+    def journal_generation(self) -> int:
+        return self._meta("journal_generation") or 0
+
+    def totals(self) -> dict:
+        stats = {"total_requests": 0, "render_success": 0, "render_failed": 0}
+        stats.update(self._db.execute("SELECT key, value FROM counters"))
+        return stats
+
+    def user_count(self) -> int:
+        return self._meta("user_count") or 0
+
+    def user(self, uid: str) -> dict | None:
+        rows = self._db.execute("SELECT key, value FROM user_counters WHERE user_id = ?", (int(uid),)).fetchall()
+        return {"requests":0, "render_success":0, **dict(rows)} if rows else None
+
+    def users(self, uids: list[str]) -> dict[str, dict]:
+        # One query per 500 ids (SQLite's default variable limit is 999)
+        out: dict[str, dict] = {}
+        for i in range(0, len(uids), 500):
+            chunk = [int(uid) for uid in uids[i:i + 500]]
+            marks = ",".join("?" * len(chunk))
+            for uid, k, value in self._db.execute(f"SELECT user_id, key, value FROM user_counters WHERE user_id IN ({marks})", chunk):
+                out.setdefault(str(uid), {"requests":0, "render_success":0})[k] = value
+        return out
+
+    def top_users(self, key: str, n: int) -> list[tuple[str, dict]]:
+        ids = [uid for (uid,) in self._db.execute(
+            "SELECT user_id FROM user_counters WHERE key = ? AND value > 0 ORDER BY value DESC, user_id DESC LIMIT ?",
+            (key, n),
+        )]
+        if not ids:
+            return []
+        users = {uid: {"requests":0, "render_success":0} for uid in ids}
+        marks = ",".join("?" * len(ids))
+        for uid, k, value in self._db.execute(f"SELECT user_id, key, value FROM user_counters WHERE user_id IN ({marks})", ids):
+            users[uid][k] = value
+        return [(str(uid), users[uid]) for uid in ids]
+
+    def buckets(self, period: str, since: int, until: int) -> dict[int, dict]:
+        out: dict[int, dict] = {}
+        rows = self._db.execute(
+            "SELECT start, key, value FROM stat_buckets WHERE period = ? AND start BETWEEN ? AND ?", (period, since, until),
+        )
+        for start, key, value in rows:
+            out.setdefault(start, {})[key] = value
+        return out
+
+    def mtime(self) -> int:
+        out = 0
+        for f in (self.path, self.path.with_name(self.path.name + "-wal")):
+            try:
+                out = max(out, f.stat().st_mtime_ns)
+            except OSError:
+                pass
+        return out
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._db.close()
+
+def make_backend(kind: str = "json", path: str | None = None):
+    if kind == "json":
+        return JSONBackend(path)
+    if kind == "sqlite":
+        return SQLiteBackend(path)
+    raise ValueError(f"unknown storage backend: {kind}")
+
+# Counters are write-behind: inc_stat/inc_user only touch memory. A background
+# thread appends the pending deltas to an append-only journal every second and
+# folds the journal into the backend every `flush_interval` seconds (and on
+# close). Deltas left in the journal by a crash are replayed on startup.
+# Journal lines carry a generation number that the backend stores together
+# with the deltas it applies, so lines already folded in before a crash (the
+# journal is removed only after the backend write) are skipped on replay.
+# The same thread watches the backend's mtime so the cached AuthSnapshot also
+# picks up edits made to the state file by hand.
+class Storage:
+    def __init__(
+        self,
+        path: str | None = None,
+        backend=None,
+        flush_interval: float = 30.0,
+        journal_interval: float = 1.0,
+        hourly_retention_days: int = 14,
+    ):
+        if backend is None or isinstance(backend, str):
+            backend = make_backend(backend or "json", path)
+        self.backend = backend
+        self.path = backend.path
+        self.journal_path = self.path.with_suffix(".journal")
+        self.flush_interval = flush_interval
+        self.journal_interval = journal_interval
+        self.hourly_retention_days = hourly_retention_days  # daily buckets are kept; 0 keeps hourly too
+        self._lock = threading.RLock()     # guards the in-memory deltas, never held during I/O
+        self._io_lock = threading.RLock()  # serialises backend / journal access
+        self._pending = _new_deltas()      # not yet in the journal
+        self._unflushed = _new_deltas()    # not yet in the backend (superset of _pending)
+        self._generation = 0               # of the current journal file
+        self._user_known: dict[str, bool] = {}  # unflushed uid -> already in the backend (under _io_lock)
+        self._closed = False
+        self._replay_journal()
+        self._refresh_auth()
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._run_flusher, name="storage-flusher", daemon=True)
+        self._flusher.start()
+
+    # ---------- Write-behind counters ----------
+    def _replay_journal(self) -> None:
+        applied = self.backend.journal_generation()
+        self._generation = applied + 1
+        if not self.journal_path.exists():
+            return
+        deltas = _new_deltas()
+        newest = applied
+        with self.journal_path.open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    generation = entry.get("generation", applied + 1)  # untagged: older journals
+                    if generation <= applied:
+                        continue
+                    _merge_deltas(deltas, entry)
+                except (ValueError, KeyError):
+                    break  # torn last line from a crash mid-append
+                newest = max(newest, generation)
+        if newest > applied:
+            self.backend.apply_deltas(deltas, generation=newest)
+        self.journal_path.unlink()
+        self._generation = newest + 1
+
+    def _append_journal(self) -> None:
+        # Swapping _pending under _io_lock keeps a concurrent flush from
+        # folding these deltas into the backend before they reach the journal
+        with self._io_lock:
+            with self._lock:
+                pending, self._pending = self._pending, _new_deltas()
+            if _is_empty(pending):
+                return
+            with self.journal_path.open("a", encoding="utf-8") as f:
+                line = {**pending, "generation": self._generation}
+                f.write(json.dumps(line, ensure_ascii=False, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def flush(self) -> None:
+        with self._io_lock:
+            self._append_journal()
+            # Deltas that arrived since are part of the snapshot too, so they
+            # must not reach the journal afterwards
+            with self._lock:
+                snapshot = _new_deltas()
+                _merge_deltas(snapshot, self._unflushed)
+                late, self._pending = self._pending, _new_deltas()
+            if _is_empty(snapshot):
+                return
+            cutoff = int(time.time()) - self.hourly_retention_days * DAY if self.hourly_retention_days > 0 else 0
+            try:
+                self.backend.apply_deltas(snapshot, cutoff, generation=self._generation)
+            except Exception:
+                with self._lock:
+                    _merge_deltas(self._pending, late)
+                raise
+            self.journal_path.unlink(missing_ok=True)
+            self._generation += 1
+            with self._lock:
+                _merge_deltas(self._unflushed, snapshot, sign=-1)
+                remaining = set(self._unflushed["per_user"])
+            flushed = snapshot["per_user"]
+            self._user_known = {
+                uid: known or uid in flushed for uid, known in self._user_known.items() if uid in remaining
+            }
+
+    def _run_flusher(self) -> None:
+        last_flush = time.monotonic()
+        while not self._stop.wait(self.journal_interval):
+            try:
+                if self.backend.mtime() != self._auth_mtime:
+                    self._refresh_auth()
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    self.flush()
+                    last_flush = time.monotonic()
+                else:
+                    self._append_journal()
+            except Exception as e:
+                print(f"[storage] flush error: {e}")
+
+    def close(self) -> None:
+        # Idempotent: RUN_MODE=all may reach shutdown from more than one place
+        self._stop.set()
+        self._flusher.join(timeout=5)
+        with self._io_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self.flush()
+            self.backend.close()
+
+    # ---------- Authorization snapshot ----------
+    def _refresh_auth(self, conf: dict | None = None) -> None:
+        with self._io_lock:
+            if conf is None:
+                conf = self.backend.load_config()
+            self._auth = AuthSnapshot.from_config(conf)
+            self._auth_mtime = self.backend.mtime()
+
+    def auth(self) -> AuthSnapshot:
+        return self._auth
+
     def get(self) -> dict:
-        with self._lock:
-            return self._read()
+        with self._io_lock:
+            data = self.backend.load()
+            with self._lock:
+                _apply_deltas(data, self._unflushed)
+            return data
+
+    def update_config(self, fn) -> dict:
+        with self._io_lock:
+            conf = self.backend.load_config()
+            fn(conf)
+            self.backend.save_config(conf)
+            self._refresh_auth(conf)
+            return conf
 
     def update(self, fn) -> dict:
-        with self._lock:
-            data = self._read()
+        # Only the "config" section of the document is persisted; counters
+        # go through inc_stat/inc_user.
+        with self._io_lock:
+            data = self.get()
             fn(data)
-            self._write(data)
+            self.backend.save_config(data["config"])
+            self._refresh_auth(data["config"])
             return data
 
+    # ---------- Stats queries ----------
+    # Backend reads plus the deltas not flushed yet; cost depends on the
+    # page size and the number of users active since the last flush, not on
+    # how many users there are in total.
+    def _pending_users(self) -> dict[str, dict]:
+        with self._lock:
+            return {uid: dict(c) for uid, c in self._unflushed["per_user"].items()}
+
+    def _new_users(self) -> int:
+        # Unflushed users the backend has not seen yet. inc_user runs on the
+        # event loop and cannot query the backend, so each uid is looked up
+        # once per flush window, in one batch, the first time it is counted.
+        with self._lock:
+            uids = list(self._unflushed["per_user"])
+        unchecked = [uid for uid in uids if uid not in self._user_known]
+        if unchecked:
+            known = self.backend.users(unchecked)
+            for uid in unchecked:
+                self._user_known[uid] = uid in known
+        return sum(1 for uid in uids if not self._user_known[uid])
+
+    def totals(self) -> dict:
+        with self._io_lock:
+            stats = self.backend.totals()
+            users = self.backend.user_count() + self._new_users()
+            with self._lock:
+                _add(stats, self._unflushed["stats"])
+        stats["users"] = users
+        return stats
+
+    def user_stats(self, user_id: int) -> dict | None:
+        uid = str(user_id)
+        with self._io_lock:
+            counters = self.backend.user(uid)
+            pending = self._pending_users().get(uid)
+        if pending is not None:
+            counters = counters or {"requests":0, "render_success":0}
+            _add(counters, pending)
+        return counters
+
+    def top_users(self, key: str = "requests", limit: int = 20, offset: int = 0) -> list[tuple[int, dict]]:
+        if key not in USER_KEYS:
+            raise ValueError(f"unknown user counter: {key}")
+        with self._io_lock:
+            pending = self._pending_users()
+            # Pending users are ranked below with their merged counters, so
+            # the backend only has to supply offset+limit others; counters
+            # only grow, so no one else can move up
+            want = n = offset + limit
+            while True:
+                rows = self.backend.top_users(key, n)
+                also_pending = sum(1 for uid, _ in rows if uid in pending)
+                if len(rows) < n or len(rows) - also_pending >= want:
+                    break
+                n = want + also_pending
+            rows = dict(rows)
+            base = self.backend.users([uid for uid in pending if uid not in rows])
+            for uid, counters in pending.items():
+                merged = rows.get(uid) or base.get(uid) or {"requests":0, "render_success":0}
+                _add(merged, counters)
+                rows[uid] = merged
+        ranked = _top(rows.items(), key, offset + limit)[offset:]
+        return [(int(uid), counters) for uid, counters in ranked]
+
+    def buckets(self, period: str, since: int, until: int) -> list[tuple[int, dict]]:
+        # Global counters per UTC hour or day, oldest first; empty buckets are omitted
+        if period not in PERIODS:
+            raise ValueError(f"unknown period: {period}")
+        with self._io_lock:
+            rows = self.backend.buckets(period, since, until)
+            with self._lock:
+                pending = _bucket_deltas(self._unflushed)[period]
+        for start, counters in pending.items():
+            if since <= start <= until:
+                _add(rows.setdefault(start, {}), counters)
+        return sorted(rows.items())
+
     # High-level helpers
     def inc_stat(self, key: str, by: int = 1):
-        def _fn(d):
-            d["stats"][key] = d["stats"].get(key, 0) + by
-        self.update(_fn)
+        hour = str(int(time.time()) // HOUR * HOUR)
+        with self._lock:
+            for d in (self._pending, self._unflushed):
+                d["stats"][key] = d["stats"].get(key, 0) + by
+                bucket = d["hourly"].setdefault(hour, {})
+                bucket[key] = bucket.get(key, 0) + by
 
     def inc_user(self, user_id: int, key: str, by: int = 1):
-        def _fn(d):
-            per = d["stats"]["per_user"]
-            user = per.get(str(user_id), {"requests":0, "render_success":0})
-            user[key] = user.get(key, 0) + by
-            per[str(user_id)] = user
-        self.update(_fn)
+        with self._lock:
+            for d in (self._pending, self._unflushed):
+                user = d["per_user"].setdefault(str(user_id), {})
+                user[key] = user.get(key, 0) + by
 
     def lists(self) -> tuple[list[int], list[int]]:
-        d = self.get()
-        return d["config"]["whitelist"], d["config"]["blacklist"]
+        conf = self.config()
+        return conf["whitelist"], conf["blacklist"]
 
     def set_public(self, enabled: bool):
-        self.update(lambda d: d["config"].__setitem__("public_enabled", enabled))
+        self.update_config(lambda c: c.__setitem__("public_enabled", enabled))
 
     def modify_list(self, list_name: str, add: list[int] | None = None, remove: list[int] | None = None):
         add = add or []
         remove = remove or []
-        def _fn(d):
-            cur: list[int] = d["config"][list_name]
+        def _fn(c):
+            cur: list[int] = c[list_name]
             cur = list(sorted(set([*cur, *add]) - set(remove)))
-            d["config"][list_name] = cur
-        self.update(_fn)
+            c[list_name] = cur
+        self.update_config(_fn)
 
     def config(self) -> dict:
-        return self.get()["config"]
+        with self._io_lock:
+            return self.backend.load_config()
@@ -1,4 +1,5 @@
 from __future__ import annotations
+import time
 from typing import Iterable
 
 def parse_ints(parts: Iterable[str]) -> list[int]:
@@ -9,3 +10,20 @@ def parse_ints(parts: Iterable[str]) -> list[int]:
         except ValueError:
             pass
     return out
+
+class StageTimer:
+    # Accumulates wall time per named stage: call lap(stage) at the end of each stage
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def merge(self, stages: dict[str, float]) -> None:
+        # Add stages measured elsewhere (e.g. a worker process) and restart the lap clock
+        for stage, seconds in stages.items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self._last = time.perf_counter()
@@ -0,0 +1,414 @@
+from __future__ import annotations
+import asyncio, itertools, json, os, shutil, struct, sys, tempfile
+from contextlib import aclosing
+from pathlib import Path
+from typing import AsyncIterator, Callable, Optional
+
+from .renderer import RenderTimeout
+from .utils import StageTimer
+
+# Out-of-process rendering. The main process listens on a private Unix socket
+# and spawns `python -m src.workers <socket> <index>` children; each child owns
+# its own BrowserPool and does Markdown parsing, the Pillow fast path ("fast":
+# true) and screenshots, so the main event loop only does Telegram/HTTP I/O. Frames are a fixed header with two
+# lengths, a JSON header and an optional raw body (the image bytes). Tiled
+# jobs answer with one frame per tile ("more": true) and an empty final frame;
+# the child keeps at most _TILE_WINDOW tiles unacknowledged, the parent acks
+# each one as its consumer takes it and sends "cancel" if it stops early.
+# Final frames carry the worker's per-stage timings for the metrics and its
+# browser pool's intervention counters, which the parent re-reports as deltas.
+
+ROOT = Path(__file__).resolve().parents[1]
+_FRAME = struct.Struct("!II")
+_TILE_WINDOW = 2
+
+class WorkerCrashed(Exception):
+    pass
+
+def _error_frame(job_id: int, e: Exception, health: dict) -> dict:
+    # "kind" lets the parent re-raise timeouts as RenderTimeout
+    kind = "timeout" if isinstance(e, RenderTimeout) else "error"
+    return {"id": job_id, "ok": False, "kind": kind, "error": str(e) or type(e).__name__, "health": health}
+
+def _error(header: dict) -> Exception:
+    message = header.get("error") or "render failed"
+    return RenderTimeout(message) if header.get("kind") == "timeout" else RuntimeError(message)
+
+def _post(writer: asyncio.StreamWriter, header: dict, body: bytes = b"") -> None:
+    # Without waiting for the buffer to drain; for small control frames
+    head = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    writer.writelines((_FRAME.pack(len(head), len(body)), head, body))
+
+async def _send(writer: asyncio.StreamWriter, header: dict, body: bytes = b"") -> None:
+    _post(writer, header, body)
+    await writer.drain()
+
+async def _recv(reader: asyncio.StreamReader) -> tuple[dict, bytes]:
+    n_head, n_body = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    header = json.loads(await reader.readexactly(n_head))
+    body = await reader.readexactly(n_body) if n_body else b""
+    return header, body
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.connected = asyncio.Event()
+        self.pending: dict[int, asyncio.Future] = {}
+        self.streams: dict[int, asyncio.Queue] = {}
+        self.health: dict[str, int] = {}  # last browser counters reported by this process
+
+class WorkerPool:
+    def __init__(
+        self,
+        count: int = 2,
+        connect_timeout: float = 60.0,
+        job_timeout: float = 0,
+        on_event: Optional[Callable[[str, int], None]] = None,
+    ):
+        self.count = max(1, count)
+        self.connect_timeout = connect_timeout
+        self.job_timeout = job_timeout  # kill a worker that sits on a job this long; 0 disables
+        self.on_event = on_event
+        self.browser: dict[str, int] = {}  # browser counters summed over all workers and restarts
+        self.restarts = 0
+        self.killed = 0
+        self._workers = [_Worker(i) for i in range(self.count)]
+        self._ids = itertools.count()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._sock_dir: Optional[str] = None
+        self._supervisors: list[asyncio.Task] = []
+        self._closing = False
+        self._lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        if self._server is not None:
+            return
+        async with self._lock:
+            if self._server is not None:
+                return
+            self._closing = False
+            self._sock_dir = tempfile.mkdtemp(prefix="md2img-")
+            path = os.path.join(self._sock_dir, "render.sock")
+            self._server = await asyncio.start_unix_server(self._on_connect, path=path)
+            self._supervisors = [asyncio.create_task(self._supervise(w, path)) for w in self._workers]
+
+    async def close(self) -> None:
+        async with self._lock:
+            if self._server is None:
+                return
+            self._closing = True
+            for w in self._workers:
+                if w.writer is not None:
+                    try:
+                        await _send(w.writer, {"shutdown": True})
+                    except ConnectionError:
+                        pass
+            for w in self._workers:
+                if w.proc is not None:
+                    try:
+                        await asyncio.wait_for(w.proc.wait(), timeout=10)
+                    except asyncio.TimeoutError:
+                        w.proc.kill()
+            for task in self._supervisors:
+                task.cancel()
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            shutil.rmtree(self._sock_dir, ignore_errors=True)
+
+    def _fail(self, w: _Worker, exc: Exception) -> None:
+        pending, w.pending = w.pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(exc)
+        streams, w.streams = w.streams, {}
+        for queue in streams.values():
+            queue.put_nowait(exc)
+
+    async def _supervise(self, w: _Worker, path: str) -> None:
+        # Keep one child process alive per slot, restarting it with backoff
+        loop = asyncio.get_running_loop()
+        backoff = 1.0
+        while not self._closing:
+            started = loop.time()
+            w.proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "src.workers", path, str(w.index), cwd=ROOT,
+            )
+            code = await w.proc.wait()
+            w.proc = None
+            self._fail(w, WorkerCrashed(f"render worker {w.index} exited with code {code}"))
+            if self._closing:
+                break
+            self.restarts += 1
+            backoff = 1.0 if loop.time() - started > 60 else min(backoff * 2, 30.0)
+            print(f"[workers] worker {w.index} exited with code {code}, restarting in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            header, _ = await _recv(reader)
+            w = self._workers[header["hello"]]
+        except (asyncio.IncompleteReadError, ConnectionError, KeyError, IndexError, ValueError):
+            writer.close()
+            return
+        w.writer = writer
+        w.health = {}
+        w.connected.set()
+        try:
+            while True:
+                header, body = await _recv(reader)
+                if "health" in header:
+                    self._health(w, header["health"])
+                queue = w.streams.get(header["id"])
+                if queue is not None:
+                    if not header.get("ok"):
+                        queue.put_nowait(_error(header))
+                    else:
+                        queue.put_nowait(body if header.get("more") else header.get("stages") or {})
+                    continue
+                fut = w.pending.pop(header["id"], None)
+                if fut is None or fut.done():
+                    continue
+                if header.get("ok"):
+                    fut.set_result((body, header.get("stages") or {}))
+                else:
+                    fut.set_exception(_error(header))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            w.connected.clear()
+            w.writer = None
+            self._fail(w, WorkerCrashed(f"render worker {w.index} disconnected"))
+            writer.close()
+
+    def _health(self, w: _Worker, counters: dict[str, int]) -> None:
+        for kind, n in counters.items():
+            delta = n - w.health.get(kind, 0)
+            if delta > 0:
+                self.browser[kind] = self.browser.get(kind, 0) + delta
+                if self.on_event is not None:
+                    self.on_event(kind, delta)
+        w.health = dict(counters)
+
+    async def _pick(self) -> _Worker:
+        await self.start()
+        # Prefer connected workers, then the one with the fewest jobs in flight
+        w = min(self._workers, key=lambda w: (not w.connected.is_set(), len(w.pending) + len(w.streams)))
+        await asyncio.wait_for(w.connected.wait(), timeout=self.connect_timeout)
+        if w.writer is None:
+            raise WorkerCrashed(f"render worker {w.index} is not connected")
+        return w
+
+    async def _call(self, w: _Worker, header: dict) -> tuple[bytes, dict]:
+        job_id = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        w.pending[job_id] = fut
+        try:
+            await _send(w.writer, {"id": job_id, **header})
+            try:
+                return await asyncio.wait_for(fut, self.job_timeout or None)
+            except asyncio.TimeoutError:
+                # The worker enforces its own render deadline; silence past
+                # this means its event loop or browser is wedged
+                self.killed += 1
+                if self.on_event is not None:
+                    self.on_event("worker_kills", 1)
+                print(f"[workers] worker {w.index} did not answer in {self.job_timeout:g}s, killing it")
+                if w.proc is not None:
+                    w.proc.kill()
+                raise RenderTimeout(f"render worker timed out after {self.job_timeout:g}s") from None
+        finally:
+            w.pending.pop(job_id, None)
+
+    async def render(
+        self,
+        md: str,
+        *,
+        width: int,
+        theme: Optional[str] = None,
+        fmt: str = "png",
+        quality: int = 85,
+        fast: bool = False,
+        timer: Optional[StageTimer] = None,
+    ) -> bytes:
+        body, stages = await self._call(await self._pick(), {
+            "md": md, "width": width, "theme": theme, "fmt": fmt, "quality": quality, "fast": fast,
+        })
+        if timer is not None:
+            timer.merge(stages)
+        return body
+
+    async def warm_up(self, md: str, *, width: int, fmt: str = "png", quality: int = 85) -> None:
+        # One job on every worker, unlike render() which picks the least busy
+        await self.start()
+
+        async def one(w: _Worker):
+            await asyncio.wait_for(w.connected.wait(), timeout=self.connect_timeout)
+            if w.writer is None:
+                raise WorkerCrashed(f"render worker {w.index} is not connected")
+            await self._call(w, {"md": md, "width": width, "theme": None, "fmt": fmt, "quality": quality})
+        await asyncio.gather(*(one(w) for w in self._workers))
+
+    async def render_tiles(
+        self,
+        md: str,
+        *,
+        width: int,
+        theme: Optional[str] = None,
+        fmt: str = "png",
+        quality: int = 85,
+        tile_height: int = 2048,
+        fast: bool = False,
+        timer: Optional[StageTimer] = None,
+    ) -> AsyncIterator[bytes]:
+        # With `fast` a page the fast path can draw within one tile comes back as that single image
+        w = await self._pick()
+        job_id = next(self._ids)
+        # Unacked tiles plus the final frame and a possible crash error
+        queue: asyncio.Queue = asyncio.Queue(maxsize=_TILE_WINDOW + 2)
+        w.streams[job_id] = queue
+        finished = False
+        try:
+            await _send(w.writer, {
+                "id": job_id, "md": md, "width": width, "theme": theme, "fmt": fmt, "quality": quality,
+                "tile_height": tile_height, "fast": fast,
+            })
+            while True:
+                item = await queue.get()
+                if isinstance(item, dict):
+                    finished = True
+                    if timer is not None:
+                        timer.merge(item)
+                    return
+                if isinstance(item, Exception):
+                    finished = True
+                    raise item
+                yield item
+                if w.writer is not None:
+                    await _send(w.writer, {"id": job_id, "ack": True})
+        finally:
+            w.streams.pop(job_id, None)
+            if not finished and w.writer is not None:
+                _post(w.writer, {"id": job_id, "cancel": True})
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.count,
+            "connected": sum(w.connected.is_set() for w in self._workers),
+            "in_flight": sum(len(w.pending) + len(w.streams) for w in self._workers),
+            "restarts": self.restarts,
+            "killed": self.killed,
+            "browser": dict(self.browser),
+        }
+
+# ---------- Worker process ----------
+async def _serve(path: str, index: int) -> None:
+    from .config import cfg
+    from .fastpath import FastRenderer
+    from .renderer import ASSETS_DIR, BrowserPool, MarkdownPipeline, Renderer
+    fast = FastRenderer.from_assets(
+        ASSETS_DIR, extra_fonts=tuple(p.strip() for p in cfg.fast_render_fonts.split(",") if p.strip()),
+    ) if cfg.fast_render else None
+    renderer = Renderer(
+        width=cfg.render_width,
+        pool=BrowserPool(
+            browsers=cfg.browser_pool_size,
+            pages_per_browser=cfg.pages_per_browser,
+            recycle_after=cfg.browser_recycle_renders,
+            max_rss_mb=cfg.browser_max_rss_mb,
+            check_interval=cfg.browser_check_interval,
+        ),
+        pipeline=MarkdownPipeline.from_assets(default_theme=cfg.render_theme),
+        timeout=cfg.render_timeout,
+        fast=fast if fast is not None and fast.available else None,
+    )
+
+    async def try_fast(header: dict, timer: StageTimer, max_height: int = 0):
+        if not header.get("fast") or renderer.fast is None:
+            return None, None
+        return await renderer.try_fast(
+            header["md"], width=header["width"], theme=header["theme"], fmt=header["fmt"],
+            quality=header["quality"], timer=timer, max_height=max_height,
+        )
+
+    reader, writer = await asyncio.open_unix_connection(path)
+    await _send(writer, {"hello": index})
+
+    async def tiles(header: dict, timer: StageTimer) -> AsyncIterator[bytes]:
+        parsed, png = await try_fast(header, timer, max_height=header["tile_height"])
+        if png is not None:
+            yield png
+            return
+        tiles = renderer.render_tiles_local(
+            header["md"], width=header["width"], theme=header["theme"], fmt=header["fmt"],
+            quality=header["quality"], tile_height=header["tile_height"], timer=timer, parsed=parsed,
+        )
+        async with aclosing(tiles):
+            async for tile in tiles:
+                yield tile
+
+    async def tiles_job(header: dict) -> None:
+        timer = StageTimer()
+        credit = credits[header["id"]] = asyncio.Semaphore(_TILE_WINDOW)
+        try:
+            async with aclosing(tiles(header, timer)) as stream:
+                async for tile in stream:
+                    await credit.acquire()
+                    await _send(writer, {"id": header["id"], "ok": True, "more": True}, tile)
+        except Exception as e:
+            await _send(writer, _error_frame(header["id"], e, renderer.pool.counters))
+            return
+        await _send(writer, {
+            "id": header["id"], "ok": True, "more": False, "stages": timer.stages, "health": renderer.pool.counters,
+        })
+
+    async def job(header: dict) -> None:
+        if header.get("tile_height"):
+            return await tiles_job(header)
+        timer = StageTimer()
+        try:
+            parsed, png = await try_fast(header, timer)
+            if png is None:
+                png = await renderer.render_local(
+                    header["md"], width=header["width"], theme=header["theme"],
+                    fmt=header["fmt"], quality=header["quality"], timer=timer, parsed=parsed,
+                )
+        except Exception as e:
+            await _send(writer, _error_frame(header["id"], e, renderer.pool.counters))
+            return
+        await _send(writer, {"id": header["id"], "ok": True, "stages": timer.stages, "health": renderer.pool.counters}, png)
+
+    tasks: dict[int, asyncio.Task] = {}
+    credits: dict[int, asyncio.Semaphore] = {}
+
+    def done(job_id: int) -> None:
+        tasks.pop(job_id, None)
+        credits.pop(job_id, None)
+
+    try:
+        while True:
+            header, _ = await _recv(reader)
+            if header.get("shutdown"):
+                break
+            if header.get("ack"):
+                if header["id"] in credits:
+                    credits[header["id"]].release()
+                continue
+            if header.get("cancel"):
+                if header["id"] in tasks:
+                    tasks[header["id"]].cancel()
+                continue
+            task = tasks[header["id"]] = asyncio.create_task(job(header))
+            task.add_done_callback(lambda _, job_id=header["id"]: done(job_id))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        await renderer.close()
+        writer.close()
+
+if __name__ == "__main__":
+    asyncio.run(_serve(sys.argv[1], int(sys.argv[2])))